@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+## memory-mapped columnar store for the CCRB allegations
+# an uncompressed Arrow IPC (Feather v2) file sorted by incident year and FADO
+# type, written as record batches that never straddle a (year, FADO type)
+# pair. A sidecar index records each batch's year, FADO type and row count, so
+# scan_allegations can skip every batch outside the requested years/types and
+# memory-map only the ones it needs; nothing else is read from disk. It hands
+# back an Arrow table over the mapped batches, so nothing is copied until the
+# caller converts what it keeps. read_allegations makes the same selection
+# from the parquet dataset, for when the store hasn't been built.
+#
+# every batch carries the same dictionary of commands (every command in the
+# dataset), so store_commands reads the distinct commands off the first
+# batch's dictionary without touching the rows.
+#
+# usage (from the repo root, after Code/build_ccrb_dataset.py):
+#   python Code/allegations_store.py
+
+DEFAULT_SOURCE = 'Data/Processed Data/ccrb_allegations_with_labels.parquet'
+DEFAULT_STORE = 'Data/Processed Data/ccrb_allegations.arrow'
+
+STORE_COLUMNS = [
+    'Complaint Id',
+    'Incident Date',
+    'incident_year',
+    'command_normalized',
+    'FADO Type',
+    'CCRB disposition substantiated'
+]
+
+def index_path(store_path):
+    return store_path + '.index.json'
+
+def read_source_year(source, incident_year, categories):
+    year_filter = (
+        ds.field('incident_year').is_null() if pd.isna(incident_year)
+        else ds.field('incident_year') == incident_year
+    )
+
+    allegations = (
+        source
+        .to_table(columns=STORE_COLUMNS, filter=year_filter)
+        .to_pandas()
+    )
+
+    # every batch must carry identical dictionaries for the IPC file format
+    return (
+        allegations
+        .fillna({'CCRB disposition substantiated':False})
+        .astype({
+            'incident_year':'Int16',
+            'command_normalized':categories['command_normalized'],
+            'FADO Type':categories['FADO Type'],
+            'CCRB disposition substantiated':bool
+        })
+        .sort_values(['FADO Type','command_normalized','Complaint Id'])
+    )
+
+def build_allegations_store(source_path=DEFAULT_SOURCE, store_path=DEFAULT_STORE, max_batch_rows=64_000):
+    source = ds.dataset(source_path, format='parquet')
+
+    # dictionaries and years come from single-column scans, so only one
+    # incident year of allegations is held in memory at a time
+    key_columns = source.to_table(columns=['incident_year','command_normalized','FADO Type'])
+    categories = {
+        column: pd.CategoricalDtype(
+            sorted(key_columns[column].drop_null().cast(pa.string()).unique().to_pylist())
+        )
+        for column in ['command_normalized','FADO Type']
+    }
+    incident_years = sorted(
+        key_columns['incident_year'].unique().to_pylist(),
+        key=lambda year: (year is None, year)
+    )
+    del key_columns
+
+    batch_index = []
+    staging = store_path + '.building'
+
+    with pa.OSFile(staging, 'wb') as sink:
+        writer = None
+
+        for incident_year in incident_years:
+            allegations = read_source_year(source, incident_year, categories)
+
+            for fado_type, allegations_of_type in allegations.groupby('FADO Type', observed=True, dropna=False, sort=False):
+                table = pa.Table.from_pandas(allegations_of_type, preserve_index=False)
+
+                if writer is None:
+                    writer = pa.ipc.new_file(sink, table.schema)
+
+                for batch in table.to_batches(max_chunksize=max_batch_rows):
+                    writer.write_batch(batch)
+                    batch_index.append({
+                        'incident_year': None if pd.isna(incident_year) else int(incident_year),
+                        'FADO Type': None if pd.isna(fado_type) else fado_type,
+                        'rows': batch.num_rows
+                    })
+
+        if writer is not None:
+            writer.close()
+
+    with open(index_path(staging), 'w') as f:
+        json.dump(batch_index, f)
+
+    os.replace(staging, store_path)
+    os.replace(index_path(staging), index_path(store_path))
+
+    print(f'wrote {sum(batch["rows"] for batch in batch_index):,} allegations in {len(batch_index):,} batches to {store_path}')
+
+def scan_allegations(store_path=DEFAULT_STORE, years=None, fado_types=None, columns=None):
+    with open(index_path(store_path)) as f:
+        batch_index = json.load(f)
+
+    selected_batches = [
+        i
+        for i, batch in enumerate(batch_index)
+        if (
+            years is None
+            or (batch['incident_year'] is not None and years[0] <= batch['incident_year'] <= years[1])
+        ) and (
+            fado_types is None
+            or batch['FADO Type'] in fado_types
+        )
+    ]
+
+    # the batches' buffers point into the memory map, so the file stays
+    # mapped for as long as the returned columns reference it
+    reader = pa.ipc.open_file(pa.memory_map(store_path))
+
+    allegations = pa.Table.from_batches(
+        [reader.get_batch(i) for i in selected_batches],
+        schema=reader.schema
+    )
+
+    if columns is not None:
+        allegations = allegations.select(columns)
+
+    return allegations
+
+def store_commands(store_path=DEFAULT_STORE):
+    reader = pa.ipc.open_file(pa.memory_map(store_path))
+    if reader.num_record_batches == 0:
+        return []
+    return reader.get_batch(0).column('command_normalized').dictionary.to_pylist()
+
+def source_commands(source_path=DEFAULT_SOURCE):
+    # the distinct commands of the parquet dataset, a batch at a time
+    commands = set()
+    for batch in ds.dataset(source_path, format='parquet').to_batches(columns=['command_normalized']):
+        commands.update(pc.unique(batch.column('command_normalized').drop_null().cast(pa.string())).to_pylist())
+    return sorted(commands)
+
+def read_allegations(source_path=DEFAULT_SOURCE, years=None, fado_types=None, columns=None):
+    # missing years and FADO types are outside any range or list, as the
+    # store's unknown batches are
+    selection = None
+    if years is not None:
+        selection = (ds.field('incident_year') >= years[0]) & (ds.field('incident_year') <= years[1])
+    if fado_types is not None:
+        of_types = ds.field('FADO Type').isin(fado_types)
+        selection = of_types if selection is None else selection & of_types
+
+    return (
+        ds.dataset(source_path, format='parquet')
+        .to_table(columns=columns, filter=selection)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the memory-mapped CCRB allegations store from the labeled parquet dataset.'
+    )
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help=f'labeled allegations parquet dataset (default: {DEFAULT_SOURCE})')
+    parser.add_argument('--store', default=DEFAULT_STORE, help=f'output Arrow IPC file (default: {DEFAULT_STORE})')
+    parser.add_argument('--max-batch-rows', type=int, default=64_000, help='maximum rows per record batch')
+    args = parser.parse_args()
+
+    build_allegations_store(args.source, args.store, args.max_batch_rows)
+
+if __name__ == '__main__':
+    main()
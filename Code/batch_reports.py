@@ -0,0 +1,249 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import ccrb_engine
+from rollups import COMMAND_LEVEL, LEVELS
+
+## headless batch reports
+#
+# usage (from the repo root):
+#   python Code/batch_reports.py grid.json --output-dir reports
+#
+# runs the app's computations for every combination of the parameters in a
+# JSON grid and writes each combination's complaints_pct_change.csv and
+# cases_summary.csv (the app's downloads) to its own numbered directory, with
+# reports.csv listing the parameters of each. A grid maps parameter names to
+# lists of values, e.g.
+#
+#   {
+#       "fado_types": [["Force"], ["Force", "Abuse of Authority"]],
+#       "substantiated_only": [false, true],
+#       "normalize_by": ["None", "Currently active officers"],
+#       "reference_years": [[2019, 2021]],
+#       "focus_years": [[2022, 2024]],
+#       "minimum_instances_threshold": [0, 3],
+#       "aggregation_level": ["Precinct/command", "Borough"]
+#   }
+#
+# parameters left out of the grid take the app's default values.
+#
+# the datasets are loaded and aggregated once, in this process, before the
+# worker pool starts, so forked workers share them copy-on-write rather than
+# loading their own (where workers are spawned instead, each loads them once
+# in its initializer). Combinations are grouped by complaint selection and
+# normalizer, and each group's year x command matrix is built once, here;
+# every window over it is then answered from its prefix sums. Each group's
+# combinations are split into chunks handed to the workers with the matrix,
+# so a grid varying only windows, thresholds or case years still runs on
+# every worker.
+
+DEFAULT_PARAMETERS = {
+    'fado_types': ['Force'],
+    'substantiated_only': False,
+    'normalize_by': 'None',
+    'reference_years': [2019, 2021],
+    'focus_years': [2022, 2024],
+    'geographic_precincts_only': False,
+    'minimum_instances_threshold': 3,
+    'case_years': [2019, 2024],
+    'with_settlement_only': False,
+    'aggregation_level': COMMAND_LEVEL
+}
+
+# parameters that pick the complaints a year x command matrix is built from
+# (and, above the command level, geographic_precincts_only: see selection_key)
+SELECTION_PARAMETERS = ['fado_types', 'substantiated_only', 'normalize_by', 'aggregation_level']
+
+INDEX_NAME = 'reports.csv'
+
+# reports are chunked into about this many tasks per worker, so a worker
+# that finishes early picks up more
+TASKS_PER_WORKER = 4
+
+datasets = None
+
+def load_worker_datasets():
+    global datasets
+    if datasets is None:
+        datasets = ccrb_engine.load_datasets()
+
+def expand_grid(grid):
+    unknown = set(grid) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError(f"unknown parameters in grid: {', '.join(sorted(unknown))}")
+
+    names = list(DEFAULT_PARAMETERS)
+    values = [grid.get(name, [DEFAULT_PARAMETERS[name]]) for name in names]
+
+    return [
+        dict(zip(names, combination))
+        for combination in itertools.product(*values)
+    ]
+
+def validate(parameters):
+    unknown_fado_types = set(parameters['fado_types']) - set(ccrb_engine.FADO_TYPES)
+    if unknown_fado_types:
+        raise ValueError(f"unknown FADO types: {', '.join(sorted(unknown_fado_types))}")
+    if parameters['normalize_by'] not in ccrb_engine.NORMALIZERS:
+        raise ValueError(f"unknown normalizer: {parameters['normalize_by']}")
+    if parameters['aggregation_level'] not in LEVELS:
+        raise ValueError(f"unknown aggregation level: {parameters['aggregation_level']}")
+
+def rolls_up_geographic_only(parameters):
+    return ccrb_engine.rolls_up_geographic_only(
+        parameters['aggregation_level'],
+        parameters['geographic_precincts_only']
+    )
+
+def selection_key(parameters):
+    return tuple(
+        tuple(parameters[name]) if isinstance(parameters[name], list) else parameters[name]
+        for name in SELECTION_PARAMETERS
+    ) + (rolls_up_geographic_only(parameters),)
+
+def write_report(report_dir, parameters, complaint_selection):
+    reference_years = tuple(parameters['reference_years'])
+    focus_years = tuple(parameters['focus_years'])
+    case_years = tuple(parameters['case_years'])
+
+    report = ccrb_engine.compute_report(
+        datasets,
+        complaint_selection,
+        parameters['normalize_by'],
+        reference_years,
+        focus_years,
+        parameters['geographic_precincts_only'],
+        parameters['minimum_instances_threshold'],
+        case_years,
+        parameters['with_settlement_only'],
+        parameters['aggregation_level']
+    )
+
+    complaints_params = ccrb_engine.describe_complaints(
+        parameters['fado_types'],
+        parameters['substantiated_only'],
+        parameters['normalize_by'],
+        reference_years,
+        focus_years,
+        parameters['geographic_precincts_only'],
+        parameters['minimum_instances_threshold'],
+        parameters['aggregation_level']
+    )
+
+    cases_params = ccrb_engine.describe_cases(
+        case_years,
+        parameters['with_settlement_only'],
+        parameters['normalize_by'],
+        parameters['aggregation_level'],
+        rolls_up_geographic_only(parameters)
+    )
+
+    os.makedirs(report_dir, exist_ok=True)
+
+    (
+        ccrb_engine.complaints_pct_change_output(
+            ccrb_engine.label_change_by_precinct(
+                report['complaints_pct_change'],
+                reference_years,
+                focus_years,
+                parameters['aggregation_level']
+            ),
+            complaints_params
+        )
+        .to_csv(os.path.join(report_dir, 'complaints_pct_change.csv'), index=False)
+    )
+
+    (
+        ccrb_engine.cases_summary_output(report['cases_summary'], parameters['aggregation_level'], cases_params)
+        .to_csv(os.path.join(report_dir, 'cases_summary.csv'), index=False)
+    )
+
+def select_complaints(parameters):
+    return ccrb_engine.select_complaints(
+        datasets,
+        parameters['fado_types'],
+        parameters['substantiated_only'],
+        parameters['normalize_by'],
+        parameters['aggregation_level'],
+        rolls_up_geographic_only(parameters)
+    )
+
+def report_tasks(by_selection, reports_per_task):
+    # (complaint selection, chunk of its (report_dir, parameters) pairs)
+    for reports in by_selection.values():
+        complaint_selection = select_complaints(reports[0][1])
+
+        for start in range(0, len(reports), reports_per_task):
+            yield complaint_selection, reports[start:start + reports_per_task]
+
+def run_reports(task):
+    complaint_selection, reports = task
+
+    for report_dir, parameters in reports:
+        write_report(report_dir, parameters, complaint_selection)
+
+    return len(reports)
+
+def run_batch(grid, output_dir, workers=None):
+    combinations = expand_grid(grid)
+    for parameters in combinations:
+        validate(parameters)
+
+    os.makedirs(output_dir, exist_ok=True)
+    report_dirs = [
+        os.path.join(output_dir, f'{i:04d}')
+        for i in range(len(combinations))
+    ]
+
+    by_selection = {}
+    for report_dir, parameters in zip(report_dirs, combinations):
+        by_selection.setdefault(selection_key(parameters), []).append((report_dir, parameters))
+
+    load_worker_datasets()
+
+    workers = workers or os.cpu_count()
+    reports_per_task = max(1, math.ceil(len(combinations) / (workers * TASKS_PER_WORKER)))
+    tasks = list(report_tasks(by_selection, reports_per_task))
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=load_worker_datasets) as pool:
+        completed = 0
+        for count in pool.map(run_reports, tasks):
+            completed += count
+            print(f'{completed}/{len(combinations)} reports written')
+
+    with open(os.path.join(output_dir, INDEX_NAME), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['report'] + list(DEFAULT_PARAMETERS))
+        for report_dir, parameters in zip(report_dirs, combinations):
+            writer.writerow(
+                [os.path.basename(report_dir)]
+                + [json.dumps(parameters[name]) for name in DEFAULT_PARAMETERS]
+            )
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compute the complaints pct change and cases summary reports for every combination of parameters in a grid.'
+    )
+    parser.add_argument('grid', help='JSON file mapping parameter names to lists of values')
+    parser.add_argument('--output-dir', default='reports', help='directory to write the reports to (default: reports)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    if int(pd.__version__.split('.')[0]) < 3:
+        # always on from pandas 3.0
+        pd.set_option('mode.copy_on_write', True)
+
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    run_batch(grid, args.output_dir, args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,615 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from allegations_store import build_allegations_store
+from batch_reports import DEFAULT_PARAMETERS
+from cases_cube import build_cases_cube
+import ccrb_engine
+import change_engine
+from command_registry import PRECINCTS, build_command_registry
+from complaints_cube import FADO_TYPES, complaint_memberships, count_by_year_by_command as count_from_cube, cube_from_memberships
+from rollups import command_groups, roll_up_complaints
+
+## benchmarks for the dashboard's computations
+#
+# usage (from the repo root):
+#   python Code/benchmark_pipeline.py --scales 1 10 100 --output benchmark.json
+#   python Code/benchmark_pipeline.py --baseline benchmark.json
+#
+# synthetic allegations, cases, roster and crime counts are generated at each
+# scale (multiples of the real datasets' sizes, in the real files' schemas and
+# layout: the per-year labeled allegations parquet dataset and its
+# memory-mapped store, the cases parquet, ...) under --data-dir, and reused by
+# later runs. Each stage of a rerun is then run against them with the app's
+# default widget values: its time is the best of --repeat runs, and its peak
+# memory is measured in one more run, three ways:
+#   - peak_bytes: Python allocations, NumPy's and pandas' included, traced
+#     with tracemalloc (which slows the run down),
+#   - arrow_peak_bytes: Arrow's allocations (the parquet and store reads,
+#     Arrow compute, conversions to pandas), which tracemalloc doesn't see,
+#     from a proxy of Arrow's memory pool installed for the run,
+#   - rss_peak_bytes: how far the process' resident set rose above where it
+#     started, memory-mapped pages touched included, from the kernel's
+#     high-water mark (Linux only: the mark is reset before each run through
+#     /proc/self/clear_refs; elsewhere it's left out).
+#
+# the charts and their specs are built inline in the app script, so
+# app_run/app_rerun time the app itself (Streamlit's AppTest): a first run
+# with empty caches, and a rerun after moving the threshold slider, which is
+# mostly chart-spec building.
+#
+# with --baseline, a stage regresses when it is more than --max-slowdown times
+# slower, or any of its peaks more than --max-memory-growth times larger,
+# than in the baseline results; stages faster than MIN_SECONDS in both are
+# too noisy to compare by time, and peaks under MIN_PEAK_BYTES in both (the
+# resident set moves by pages and allocator caching) too noisy to compare by
+# memory. The exit status is 1 if any stage regressed.
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parameterized_find_increasing_ccrb.py')
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), 'ccrb_benchmark')
+
+# approximate sizes of the real datasets
+REAL_COMPLAINTS = 110_000
+REAL_CASES = 21_250
+REAL_COMMANDS = 550
+
+ALLEGATIONS_PER_COMPLAINT = 3
+SCALES = [1, 10, 100]
+
+# complaints generated (and written) at a time
+CHUNK_COMPLAINTS = 250_000
+
+MIN_SECONDS = 0.005
+MIN_PEAK_BYTES = 2**20
+MAX_SLOWDOWN = 1.25
+MAX_MEMORY_GROWTH = 1.25
+
+DISPOSITIONS = [
+    'Substantiated (Charges)',
+    'Substantiated (Command Discipline A)',
+    'Unsubstantiated',
+    'Exonerated',
+    'Unfounded'
+]
+
+## synthetic data
+
+def synthetic_commands(rng):
+    # the precincts plus other commands (units, squads, ...) making up the
+    # rest of the roster, a few of which draw most of the complaints
+    other_commands = [f'UNIT {i:03d}' for i in range(REAL_COMMANDS - len(PRECINCTS))]
+    commands = np.array(PRECINCTS + other_commands)
+
+    weights = np.concatenate([
+        rng.uniform(0.5, 2, len(PRECINCTS)),
+        rng.pareto(2, len(other_commands)) * 0.2
+    ])
+
+    return commands, weights / weights.sum()
+
+def synthetic_allegations(rng, n_complaints, first_complaint_id, commands, command_weights):
+    allegations_per_complaint = rng.integers(1, 2 * ALLEGATIONS_PER_COMPLAINT, n_complaints)
+    n_allegations = allegations_per_complaint.sum()
+
+    incident_dates = (
+        pd.Timestamp('2000-01-01')
+        + pd.to_timedelta(rng.integers(0, 25 * 365, n_complaints), unit='D')
+    )
+
+    # most of a complaint's allegations are against officers of one command
+    complaint_commands = rng.choice(len(commands), n_complaints, p=command_weights)
+    allegation_commands = np.where(
+        rng.random(n_allegations) < 0.15,
+        rng.choice(len(commands), n_allegations, p=command_weights),
+        np.repeat(complaint_commands, allegations_per_complaint)
+    )
+
+    dispositions = np.array(DISPOSITIONS)[rng.choice(len(DISPOSITIONS), n_allegations, p=[.05, .1, .35, .25, .25])]
+
+    allegations = pd.DataFrame({
+        'Complaint Id': np.repeat(np.arange(n_complaints) + first_complaint_id, allegations_per_complaint),
+        'Incident Date': np.repeat(incident_dates.values, allegations_per_complaint),
+        'FADO Type': np.array(FADO_TYPES)[rng.choice(len(FADO_TYPES), n_allegations, p=[.5, .15, .05, .28, .02])],
+        'CCRB Allegation Disposition': dispositions,
+        'Tax ID': rng.integers(900_000, 1_000_000, n_allegations).astype(str),
+        'command_normalized': commands[allegation_commands]
+    })
+
+    allegations.loc[rng.random(n_allegations) < 0.01, 'Incident Date'] = pd.NaT
+
+    # as Code/build_ccrb_dataset.py labels them
+    return allegations.assign(
+        incident_year=allegations['Incident Date'].dt.year.astype('Int16'),
+        incident_month=allegations['Incident Date'].dt.month.astype('Int8'),
+        **{'CCRB disposition substantiated': allegations['CCRB Allegation Disposition'].str.contains('Substantiated')}
+    ).astype({'command_normalized': 'string'})
+
+def write_allegations(rng, n_complaints, output, commands, command_weights):
+    # one file per incident year per chunk, as Code/build_ccrb_dataset.py
+    # writes them
+    schema = None
+
+    for chunk_number, first in enumerate(range(0, n_complaints, CHUNK_COMPLAINTS)):
+        allegations = synthetic_allegations(
+            rng,
+            min(CHUNK_COMPLAINTS, n_complaints - first),
+            first + 1,
+            commands,
+            command_weights
+        )
+
+        for incident_year, allegations_in_year in allegations.groupby('incident_year', dropna=False):
+            partition = 'unknown' if pd.isna(incident_year) else str(incident_year)
+            os.makedirs(os.path.join(output, partition), exist_ok=True)
+
+            table = pa.Table.from_pandas(allegations_in_year, schema=schema, preserve_index=False)
+            schema = table.schema
+
+            pq.write_table(table, os.path.join(output, partition, f'part-{chunk_number:05d}.parquet'))
+
+def synthetic_cases(rng, n_cases, commands, command_weights):
+    occurrence_dates = (
+        pd.Timestamp('2000-01-01')
+        + pd.to_timedelta(rng.integers(0, 25 * 365, n_cases), unit='D')
+    )
+
+    # a third of cases are still open (no payout) and a fifth closed without one
+    payouts = np.round(rng.lognormal(10, 1.5, n_cases), 2)
+    outcome = rng.random(n_cases)
+    payouts[outcome < 0.33] = np.nan
+    payouts[(outcome >= 0.33) & (outcome < 0.53)] = 0
+
+    command = commands[rng.choice(len(commands), n_cases, p=command_weights)].astype(object)
+    command[rng.random(n_cases) < 0.3] = None
+
+    cases = pd.DataFrame({
+        'Date of Occurrence': occurrence_dates,
+        'Lit Start': occurrence_dates + pd.to_timedelta(rng.integers(30, 3 * 365, n_cases), unit='D'),
+        'Total City Payout AMT': payouts,
+        'Disposition': np.where(np.isnan(payouts), 'Pending', np.where(payouts > 0, 'Settled', 'Dismissed')),
+        'Use of Force Alleged?': rng.random(n_cases) < 0.4,
+        'Assault/ Battery Alleged?': rng.random(n_cases) < 0.3,
+        'Malicious Prosecution Alleged?': rng.random(n_cases) < 0.2,
+        'False Arrest/Imprisonment Alleged?': rng.random(n_cases) < 0.5,
+        'command_normalized': command
+    })
+
+    cases.loc[rng.random(n_cases) < 0.05, 'Date of Occurrence'] = pd.NaT
+
+    return cases
+
+def generate_data(data_dir, scale, seed=0):
+    # a directory laid out like the repo root, with the app's data files
+    # under Data/Processed Data
+    root = os.path.join(data_dir, f'scale_{scale}')
+    marker = os.path.join(root, 'generated.json')
+    settings = {
+        'scale': scale,
+        'seed': seed,
+        'complaints': REAL_COMPLAINTS * scale,
+        'cases': REAL_CASES * scale
+    }
+
+    if os.path.exists(marker):
+        with open(marker) as f:
+            if json.load(f) == settings:
+                return root
+
+    processed = os.path.join(root, 'Data', 'Processed Data')
+    os.makedirs(processed, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    commands, command_weights = synthetic_commands(rng)
+
+    print(f'generating {settings["complaints"]:,} complaints and {settings["cases"]:,} cases in {root}')
+
+    allegations_path = os.path.join(root, ccrb_engine.CCRB_ALLEGATIONS_PATH)
+    write_allegations(rng, settings['complaints'], allegations_path, commands, command_weights)
+    build_allegations_store(allegations_path, os.path.join(root, ccrb_engine.ALLEGATIONS_STORE_PATH))
+
+    synthetic_cases(rng, settings['cases'], commands, command_weights).to_parquet(
+        os.path.join(root, ccrb_engine.CASES_PATH)
+    )
+
+    (
+        pd.DataFrame({
+            'command_normalized': commands,
+            'count_officers': rng.integers(5, 300, len(commands)) * scale
+        })
+        .set_index('command_normalized')
+        .to_parquet(os.path.join(root, ccrb_engine.OFFICERS_BY_COMMAND_PATH))
+    )
+
+    pd.DataFrame({
+        'precinct': PRECINCTS,
+        'index_crimes_2024': rng.integers(500, 5_000, len(PRECINCTS)) * scale
+    }).to_csv(os.path.join(root, ccrb_engine.INDEX_CRIMES_PATH), index=False)
+
+    with open(marker, 'w') as f:
+        json.dump(settings, f)
+
+    return root
+
+## measurement
+
+MEMORY_STATS = {
+    'peak_bytes': 'peak',
+    'arrow_peak_bytes': 'arrow',
+    'rss_peak_bytes': 'rss'
+}
+
+# the proxy pools of every measured run: the buffers a run allocates outlive
+# it (the stages' results are kept), and must not outlive their pool
+arrow_pools = []
+
+def status_bytes(field):
+    # a memory field of /proc/self/status (VmRSS, VmHWM), None off Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def measure_memory(function):
+    rss_before = status_bytes('VmRSS')
+    rss_peak_reset = rss_before is not None and reset_peak_rss()
+
+    default_pool = pa.default_memory_pool()
+    arrow_pool = pa.proxy_memory_pool(default_pool)
+    arrow_pools.append(arrow_pool)
+    pa.set_memory_pool(arrow_pool)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+
+    return {
+        'peak_bytes': peak_bytes,
+        'arrow_peak_bytes': arrow_pool.max_memory(),
+        'rss_peak_bytes': status_bytes('VmHWM') - rss_before if rss_peak_reset else None
+    }
+
+def measure(function, repeat, track_memory):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+
+    memory = measure_memory(function) if track_memory else dict.fromkeys(MEMORY_STATS)
+
+    return result, {
+        'seconds': min(seconds),
+        **memory
+    }
+
+def pipeline_stages(parameters):
+    # (name, function of the earlier stages' results) in rerun order
+    reference_years = tuple(parameters['reference_years'])
+    focus_years = tuple(parameters['focus_years'])
+    case_years = tuple(parameters['case_years'])
+
+    def export_csv(results):
+        complaints_params = ccrb_engine.describe_complaints(
+            parameters['fado_types'],
+            parameters['substantiated_only'],
+            parameters['normalize_by'],
+            reference_years,
+            focus_years,
+            parameters['geographic_precincts_only'],
+            parameters['minimum_instances_threshold'],
+            parameters['aggregation_level']
+        )
+        cases_params = ccrb_engine.describe_cases(
+            case_years,
+            parameters['with_settlement_only'],
+            parameters['normalize_by'],
+            parameters['aggregation_level'],
+            ccrb_engine.rolls_up_geographic_only(parameters['aggregation_level'], parameters['geographic_precincts_only'])
+        )
+
+        return [
+            ccrb_engine.complaints_pct_change_output(
+                ccrb_engine.label_change_by_precinct(
+                    results['change_by_precinct'],
+                    reference_years,
+                    focus_years,
+                    parameters['aggregation_level']
+                ),
+                complaints_params
+            ).to_csv(index=False),
+            ccrb_engine.complaints_annual_detail_output(
+                results['normalize_complaints'],
+                parameters['aggregation_level'],
+                complaints_params
+            ).to_csv(index=False),
+            ccrb_engine.cases_summary_output(
+                results['cases_summary'],
+                parameters['aggregation_level'],
+                cases_params
+            ).to_csv(index=False)
+        ]
+
+    return [
+        ('load_command_dictionary', lambda results: ccrb_engine.load_command_dictionary()),
+        ('build_command_registry', lambda results: build_command_registry(results['load_command_dictionary'])),
+        ('load_ccrb', lambda results: ccrb_engine.load_ccrb(results['load_command_dictionary'])),
+        ('complaint_memberships', lambda results: complaint_memberships(results['load_ccrb'])),
+        ('build_complaints_cube', lambda results: cube_from_memberships(results['complaint_memberships'])),
+        ('load_normalizers', lambda results: ccrb_engine.select_normalizer(
+            parameters['normalize_by'],
+            ccrb_engine.load_officers_by_command(results['load_command_dictionary']),
+            ccrb_engine.load_index_crimes(results['load_command_dictionary'])
+        )),
+        ('load_cases', lambda results: ccrb_engine.load_cases(results['load_command_dictionary'])),
+        ('build_cases_cube', lambda results: build_cases_cube(results['load_cases'])),
+        # the FADO type and substantiated filters are a bitmap test on the cube
+        ('count_by_year_by_command', lambda results: count_from_cube(
+            results['build_complaints_cube'],
+            parameters['fado_types'],
+            parameters['substantiated_only']
+        )),
+        ('normalize_complaints', lambda results: ccrb_engine.normalize_complaints(
+            results['count_by_year_by_command'],
+            results['load_normalizers']
+        )),
+        ('complaints_matrix', lambda results: change_engine.to_year_command_matrix(
+            results['count_by_year_by_command'],
+            results['normalize_complaints']
+        )),
+        # switching the dashboard to patrol boroughs counts their complaints
+        # from their own cube
+        ('roll_up_patrol_boroughs', lambda results: ccrb_engine.normalize_at_level(
+            count_from_cube(
+                roll_up_complaints(
+                    results['complaint_memberships'],
+                    ccrb_engine.normalizer_groups(
+                        command_groups(results['build_command_registry'], 'Patrol borough'),
+                        results['load_normalizers']
+                    )
+                ),
+                parameters['fado_types'],
+                parameters['substantiated_only']
+            ),
+            results['load_normalizers'],
+            command_groups(results['build_command_registry'], 'Patrol borough')
+        )),
+        ('change_by_precinct', lambda results: ccrb_engine.filter_to_threshold(
+            ccrb_engine.compare_periods(
+                results['complaints_matrix'],
+                reference_years,
+                focus_years,
+                parameters['geographic_precincts_only'],
+                parameters['aggregation_level'],
+                results['build_command_registry']
+            ),
+            results['complaints_matrix'],
+            reference_years,
+            focus_years,
+            parameters['minimum_instances_threshold']
+        )),
+        ('ranks', lambda results: ccrb_engine.rank_commands(
+            results['complaints_matrix'],
+            results['change_by_precinct'].index,
+            (reference_years[0], focus_years[1]),
+            ccrb_engine.top_changes(results['change_by_precinct'], 10).index
+        )),
+        # the recent changes section at monthly grain: every trailing 12
+        # months against the 12 months before them
+        ('count_by_month_by_command', lambda results: ccrb_engine.count_by_period(
+            results['build_complaints_cube'],
+            parameters['fado_types'],
+            parameters['substantiated_only'],
+            'Month'
+        )),
+        ('month_command_matrix', lambda results: change_engine.to_year_command_matrix(
+            results['count_by_month_by_command'],
+            ccrb_engine.normalize_complaints(
+                results['count_by_month_by_command'],
+                results['load_normalizers']
+            )
+        )),
+        ('rolling_changes', lambda results: ccrb_engine.rolling_changes(
+            results['month_command_matrix'],
+            12,
+            'Preceding window',
+            'Month',
+            1,
+            parameters['geographic_precincts_only'],
+            parameters['aggregation_level'],
+            results['build_command_registry']
+        )),
+        ('cases_summary', lambda results: ccrb_engine.summarize_cases(
+            results['build_cases_cube'],
+            case_years,
+            parameters['with_settlement_only'],
+            results['load_normalizers']
+        )),
+        ('csv_export', export_csv)
+    ]
+
+def run_app(repeat, track_memory):
+    from streamlit.testing.v1 import AppTest
+    import streamlit as st
+
+    def first_run():
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        app = AppTest.from_file(APP_PATH, default_timeout=3600)
+        app.run()
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+        return app
+
+    def rerun(app):
+        # a new threshold keeps the loaded data and the complaint selection
+        # but redraws the complaints column
+        threshold = app.slider[2]
+        threshold.set_value(threshold.value + 1 if threshold.value < 25 else threshold.value - 1)
+        app.run()
+        if app.exception:
+            raise RuntimeError(app.exception[0].message)
+        return app
+
+    app, first_run_stats = measure(first_run, repeat, track_memory)
+    _, rerun_stats = measure(lambda: rerun(app), repeat, track_memory)
+
+    return {
+        'app_run': first_run_stats,
+        'app_rerun': rerun_stats
+    }
+
+def benchmark_scale(root, parameters, repeat, track_memory, include_app):
+    # the engine reads its data files relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        results = {}
+        stats = {}
+        for name, stage in pipeline_stages(parameters):
+            results[name], stats[name] = measure(lambda: stage(results), repeat, track_memory)
+            print(f'  {name:<26} {format_stats(stats[name])}')
+
+        if include_app:
+            for name, app_stats in run_app(repeat, track_memory).items():
+                stats[name] = app_stats
+                print(f'  {name:<26} {format_stats(app_stats)}')
+
+        stats['rows'] = {
+            'allegations': len(results['load_ccrb']),
+            'complaints_cube': len(results['build_complaints_cube']),
+            'cases': len(results['load_cases'])
+        }
+        return stats
+    finally:
+        os.chdir(cwd)
+
+def format_stats(stats):
+    peaks = ''.join(
+        f"  {label} {stats[name] / 2**20:9.1f} MiB"
+        for name, label in MEMORY_STATS.items()
+        if stats.get(name) is not None
+    )
+    return f"{stats['seconds'] * 1000:10.1f} ms{peaks}"
+
+## regressions
+
+def find_regressions(results, baseline, max_slowdown, max_memory_growth):
+    regressions = []
+
+    for scale, stages in results['scales'].items():
+        for name, stats in stages.items():
+            baseline_stats = baseline['scales'].get(scale, {}).get(name)
+            if name == 'rows' or baseline_stats is None:
+                continue
+
+            if (
+                max(stats['seconds'], baseline_stats['seconds']) >= MIN_SECONDS
+                and stats['seconds'] > baseline_stats['seconds'] * max_slowdown
+            ):
+                regressions.append(
+                    f"{scale}x {name}: {stats['seconds'] * 1000:.1f} ms, baseline {baseline_stats['seconds'] * 1000:.1f} ms"
+                )
+
+            # baselines from before a measure was recorded lack it
+            for memory_stat, label in MEMORY_STATS.items():
+                peak = stats.get(memory_stat)
+                baseline_peak = baseline_stats.get(memory_stat)
+
+                if (
+                    peak is not None
+                    and baseline_peak is not None
+                    and max(peak, baseline_peak) >= MIN_PEAK_BYTES
+                    and peak > baseline_peak * max_memory_growth
+                ):
+                    regressions.append(
+                        f"{scale}x {name}: {label} {peak / 2**20:.1f} MiB, baseline {baseline_peak / 2**20:.1f} MiB"
+                    )
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time and measure the memory of each stage of the dashboard on synthetic data at multiples of the real size.'
+    )
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help=f'multiples of the real data size (default: {" ".join(map(str, SCALES))})')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR, help=f'where synthetic data is generated and reused (default: {DEFAULT_DATA_DIR})')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage; the best is kept (default: 3)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    parser.add_argument('--no-app', action='store_true', help='skip timing the app script (and its chart specs) with AppTest')
+    parser.add_argument('--output', help='write the results as JSON, e.g. to use as a baseline later')
+    parser.add_argument('--baseline', help='results JSON from an earlier run to check for regressions')
+    parser.add_argument('--max-slowdown', type=float, default=MAX_SLOWDOWN, help=f'slowdown over the baseline that counts as a regression (default: {MAX_SLOWDOWN})')
+    parser.add_argument('--max-memory-growth', type=float, default=MAX_MEMORY_GROWTH, help=f'peak memory growth over the baseline that counts as a regression (default: {MAX_MEMORY_GROWTH})')
+    args = parser.parse_args()
+
+    if int(pd.__version__.split('.')[0]) < 3:
+        # always on from pandas 3.0, as in the app
+        pd.set_option('mode.copy_on_write', True)
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()
+        },
+        'parameters': DEFAULT_PARAMETERS,
+        'scales': {}
+    }
+
+    for scale in args.scales:
+        root = generate_data(os.path.abspath(args.data_dir), scale)
+        print(f'{scale}x:')
+        results['scales'][str(scale)] = benchmark_scale(
+            root,
+            DEFAULT_PARAMETERS,
+            args.repeat,
+            not args.no_memory,
+            not args.no_app
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.max_slowdown, args.max_memory_growth)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            raise SystemExit(1)
+        print('no regressions against the baseline')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from allegations_store import DEFAULT_STORE, build_allegations_store
+from command_normalization import normalize_commands
+
+## offline ETL for the CCRB allegations dataset read by load_ccrb()
+#
+# usage (from the repo root):
+#   python Code/build_ccrb_dataset.py \
+#       --allegations "Data/Raw Data/CCRB_allegations.csv" \
+#       --complaints "Data/Raw Data/CCRB_complaints.csv"
+#
+# the complaints export (one row per complaint) is read in chunks and kept in
+# memory; the much larger allegations export is streamed in chunks, each chunk
+# merged, labeled and appended to a parquet dataset with one directory per
+# incident year. Each export is first scanned once for its column dtypes.
+# The build is skipped when neither source file changed since the last run
+# (use --force to rebuild anyway).
+
+DEFAULT_OUTPUT = 'Data/Processed Data/ccrb_allegations_with_labels.parquet'
+
+MANIFEST_NAME = '_build_manifest.json'
+
+COMPLAINTS_DATE_COLUMNS = [
+    'Incident Date',
+    'CCRB Received Date',
+    'Close Date'
+]
+
+# narrowest first; a column takes the first kind every value of it parses as
+CSV_KINDS = [
+    ('boolean', r'(?i:true|false)'),
+    ('Int64', r'[+-]?\d+'),
+    ('float64', None),
+    ('string', None)
+]
+
+def value_kind(values):
+    # index into CSV_KINDS of the narrowest kind holding every (non-missing)
+    # value of a column of strings
+    values = values.dropna()
+    for kind_number, (kind, pattern) in enumerate(CSV_KINDS):
+        if kind == 'string':
+            return kind_number
+        if pattern is not None:
+            if values.str.fullmatch(pattern).all():
+                return kind_number
+        elif pd.to_numeric(values, errors='coerce').notna().all():
+            return kind_number
+
+def infer_csv_dtypes(path, chunksize, date_columns=()):
+    # pin each column's dtype so every chunk parses the same way: integers
+    # become nullable, text becomes string. A sample can't show that a
+    # column which looks numeric stays numeric (ids and codes turn to text
+    # or decimals far into the exports), so the kinds come from a pass over
+    # every chunk read as text, a column only widening as it goes
+    kinds = {}
+    for chunk in pd.read_csv(path, dtype=str, chunksize=chunksize):
+        for column in chunk.columns:
+            if column in date_columns or kinds.get(column) == len(CSV_KINDS) - 1:
+                continue
+            kinds[column] = max(kinds.get(column, 0), value_kind(chunk[column]))
+
+    dtypes = {column: CSV_KINDS[kind_number][0] for column, kind_number in kinds.items()}
+
+    dtypes['Tax ID'] = 'string'
+    # complaint ids are the merge key, never missing
+    dtypes['Complaint Id'] = 'int64'
+    return {column: dtype for column, dtype in dtypes.items() if column in kinds}
+
+def load_complaints(path, chunksize):
+    # the complaints are the lookup side of every allegation chunk's merge,
+    # and any chunk can reference any complaint, so they're held in memory
+    # whole. They're one row per complaint, a fraction of the allegations;
+    # each chunk is parsed and deduplicated before joining the rest, so only
+    # the finished frame is ever held, not the raw chunks besides it
+    dtypes = infer_csv_dtypes(path, chunksize, COMPLAINTS_DATE_COLUMNS + ['As Of Date'])
+
+    def prepare(chunk):
+        for column in COMPLAINTS_DATE_COLUMNS:
+            if column in chunk.columns:
+                chunk[column] = pd.to_datetime(chunk[column], errors='coerce')
+
+        return (
+            chunk
+            .drop(columns='As Of Date', errors='ignore')
+            .drop_duplicates(subset='Complaint Id')
+        )
+
+    return (
+        pd.concat(
+            prepare(chunk)
+            for chunk in pd.read_csv(path, dtype=dtypes, chunksize=chunksize)
+        )
+        .drop_duplicates(subset='Complaint Id')
+    )
+
+def label_allegations(allegations, complaints):
+    allegations = allegations.merge(
+        complaints,
+        on='Complaint Id'
+    )
+
+    labeled = allegations.assign(
+        command_normalized = normalize_commands(allegations['Officer Command At Incident']),
+        incident_year = allegations['Incident Date'].dt.year.astype('Int16')
+    )
+
+    labeled['CCRB disposition substantiated'] = (
+        labeled['CCRB Allegation Disposition']
+        .str.contains('Substantiated', na=False)
+        .astype(bool)
+    )
+
+    return labeled.astype({'command_normalized':'string'})
+
+def source_stats(*paths):
+    return {
+        os.path.abspath(path): {
+            'size': os.path.getsize(path),
+            'mtime': os.path.getmtime(path)
+        }
+        for path in paths
+    }
+
+def read_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def build_dataset(allegations_path, complaints_path, output=DEFAULT_OUTPUT, chunksize=250_000, force=False):
+    manifest = {
+        'sources': source_stats(allegations_path, complaints_path)
+    }
+
+    if not force and read_manifest(output) == manifest:
+        print(f'{output} is up to date with its sources, skipping (use --force to rebuild)')
+        return False
+
+    complaints = load_complaints(complaints_path, chunksize)
+
+    # build next to the old dataset and swap it in at the end, so an
+    # interrupted run never leaves a half-written dataset behind
+    staging = output + '.building'
+    shutil.rmtree(staging, ignore_errors=True)
+
+    schema = None
+    rows_written = 0
+
+    allegation_chunks = pd.read_csv(
+        allegations_path,
+        dtype=infer_csv_dtypes(allegations_path, chunksize, ['As Of Date']),
+        parse_dates=['As Of Date'],
+        chunksize=chunksize
+    )
+
+    for chunk_number, allegations in enumerate(allegation_chunks):
+        labeled = label_allegations(allegations, complaints)
+
+        # one file per incident year per chunk; the year stays a typed column
+        # in the files (rather than a hive partition key) so readers get the
+        # same schema whether they read one partition or the whole dataset
+        for incident_year, allegations_in_year in labeled.groupby('incident_year', dropna=False):
+            partition = 'unknown' if pd.isna(incident_year) else str(incident_year)
+            os.makedirs(os.path.join(staging, partition), exist_ok=True)
+
+            table = pa.Table.from_pandas(allegations_in_year, schema=schema, preserve_index=False)
+            schema = table.schema
+
+            pq.write_table(
+                table,
+                os.path.join(staging, partition, f'part-{chunk_number:05d}.parquet')
+            )
+
+        rows_written += len(labeled)
+        print(f'chunk {chunk_number}: {len(labeled):,} allegations written ({rows_written:,} total)')
+
+    with open(os.path.join(staging, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    elif os.path.exists(output):
+        os.remove(output)
+    os.replace(staging, output)
+
+    print(f'wrote {rows_written:,} allegations to {output}')
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the labeled CCRB allegations parquet dataset from the NYC Open Data CSV exports.'
+    )
+    parser.add_argument('--allegations', required=True, help='CCRB allegations CSV export (6xgr-kwjq)')
+    parser.add_argument('--complaints', required=True, help='CCRB complaints CSV export (2mby-ccnw)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help=f'output dataset directory (default: {DEFAULT_OUTPUT})')
+    parser.add_argument('--chunksize', type=int, default=250_000, help='allegation rows read per chunk')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the sources are unchanged')
+    parser.add_argument('--store', default=DEFAULT_STORE, help=f'memory-mapped allegations store to rebuild, empty to skip (default: {DEFAULT_STORE})')
+    args = parser.parse_args()
+
+    rebuilt = build_dataset(
+        args.allegations,
+        args.complaints,
+        output=args.output,
+        chunksize=args.chunksize,
+        force=args.force
+    )
+
+    if args.store and (rebuilt or not os.path.exists(args.store)):
+        build_allegations_store(args.output, args.store)
+
+if __name__ == '__main__':
+    main()
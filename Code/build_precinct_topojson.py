@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+## precinct boundaries as quantized, shared-arc TopoJSON
+#
+# usage (from the repo root):
+#   python Code/build_precinct_topojson.py
+#
+# the precinct GeoJSON repeats every shared border once per precinct, at full
+# float precision, with the census demographics inlined in each feature. This
+# build:
+#   - quantizes coordinates to an integer grid (QUANTIZATION steps across the
+#     bounding box) and delta-encodes them,
+#   - cuts the rings at the points where neighboring precincts meet, so each
+#     border is stored once as an arc both precincts reference,
+#   - simplifies each arc (Douglas-Peucker, junctions kept) once per level in
+#     SIMPLIFICATION_LEVELS, so neighbors stay gap-free at every level,
+#   - writes the demographics to a separate table keyed like the app's
+#     command_normalized.
+#
+# file names carry a hash of their contents, so a browser can cache them
+# indefinitely (a proxy in front of the app can mark app/static/*.topo.json
+# immutable); the manifest tells the app which file to use for a map width.
+
+DEFAULT_SOURCE = 'Code/static/precincts_census_4326_simplified.geojson'
+DEFAULT_OUTPUT_DIR = 'Code/static'
+MANIFEST_NAME = 'precincts_topojson.json'
+
+OBJECT_NAME = 'precincts'
+ID_PROPERTY = 'Precinct'
+
+QUANTIZATION = 100_000
+
+# widest map (px) each level is drawn at; its arcs are simplified to half a
+# pixel at that width. None is the unsimplified level
+SIMPLIFICATION_LEVELS = [300, 600, 1200, None]
+
+def polygons(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(f"unsupported geometry type {geometry['type']}")
+
+def quantize_ring(ring, origin, scale):
+    points = np.rint((np.asarray(ring, dtype=float)[:, :2] - origin) / scale).astype(np.int64)
+
+    # drop points that fall onto the previous one after rounding
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = (np.diff(points, axis=0) != 0).any(axis=1)
+    points = points[keep]
+
+    if (points[0] != points[-1]).any():
+        points = np.vstack([points, points[:1]])
+
+    # a ring needs three distinct points to enclose anything
+    return points if len(points) >= 4 else None
+
+def find_junctions(rings):
+    # a point is a junction where the borders meeting there differ, i.e. it
+    # is seen with different neighbors on different rings (or ring passes)
+    neighbors = {}
+    junctions = set()
+
+    for ring in rings:
+        open_ring = [tuple(point) for point in ring[:-1]]
+        for i, point in enumerate(open_ring):
+            around = frozenset([open_ring[i - 1], open_ring[(i + 1) % len(open_ring)]])
+            if point not in neighbors:
+                neighbors[point] = around
+            elif neighbors[point] != around:
+                junctions.add(point)
+
+    return junctions
+
+def cut_ring(ring, junctions):
+    open_ring = [tuple(point) for point in ring[:-1]]
+    cuts = [i for i, point in enumerate(open_ring) if point in junctions]
+
+    if not cuts:
+        # a ring no other ring touches is one closed arc; start it at its
+        # smallest point so an identical ring elsewhere dedupes against it
+        start = open_ring.index(min(open_ring))
+        rotated = open_ring[start:] + open_ring[:start]
+        return [rotated + rotated[:1]]
+
+    rotated = open_ring[cuts[0]:] + open_ring[:cuts[0]]
+    cuts = [i - cuts[0] for i in cuts] + [len(open_ring)]
+    rotated = rotated + rotated[:1]
+
+    return [rotated[start:stop + 1] for start, stop in zip(cuts[:-1], cuts[1:])]
+
+def douglas_peucker(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, stop = stack.pop()
+        if stop - start < 2:
+            continue
+
+        segment = points[stop] - points[start]
+        offsets = points[start + 1:stop] - points[start]
+        length = np.hypot(*segment)
+
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            keep[start + 1 + farthest] = True
+            stack.append((start, start + 1 + farthest))
+            stack.append((start + 1 + farthest, stop))
+
+    return points[keep]
+
+def simplify_arc(arc, tolerance):
+    if not tolerance or len(arc) <= 2:
+        return arc
+
+    if (arc[0] == arc[-1]).all():
+        # a closed arc has no junction to anchor it: split it at its
+        # farthest point so both halves keep a real extent
+        farthest = int(np.argmax(np.hypot(*(arc - arc[0]).T)))
+        simplified = np.vstack([
+            douglas_peucker(arc[:farthest + 1], tolerance),
+            douglas_peucker(arc[farthest:], tolerance)[1:]
+        ])
+        return simplified if len(simplified) >= 4 else arc
+
+    return douglas_peucker(arc, tolerance)
+
+def delta_encode(arc):
+    return np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist()
+
+def build_topology(features):
+    coordinates = np.concatenate([
+        np.asarray(ring, dtype=float)[:, :2]
+        for feature in features
+        for polygon in polygons(feature['geometry'])
+        for ring in polygon
+    ])
+    origin = coordinates.min(axis=0)
+    scale = (coordinates.max(axis=0) - origin) / (QUANTIZATION - 1)
+
+    quantized = [
+        [
+            [ring for ring in (quantize_ring(ring, origin, scale) for ring in polygon) if ring is not None]
+            for polygon in polygons(feature['geometry'])
+        ]
+        for feature in features
+    ]
+
+    junctions = find_junctions([
+        ring
+        for feature_polygons in quantized
+        for polygon in feature_polygons
+        for ring in polygon
+    ])
+
+    arcs = []
+    arc_index = {}
+
+    def arc_reference(arc):
+        if arc in arc_index:
+            return arc_index[arc]
+        if arc[::-1] in arc_index:
+            return ~arc_index[arc[::-1]]
+        if arc[0] == arc[-1] and len(arc) > 2:
+            # the same closed ring walked the other way round
+            reversed_ring = cut_ring(np.asarray(arc[::-1]), set())[0]
+            if tuple(reversed_ring) in arc_index:
+                return ~arc_index[tuple(reversed_ring)]
+        arc_index[arc] = len(arcs)
+        arcs.append(np.asarray(arc))
+        return arc_index[arc]
+
+    geometries = []
+    for feature, feature_polygons in zip(features, quantized):
+        arc_polygons = [
+            [
+                [arc_reference(tuple(arc)) for arc in cut_ring(ring, junctions)]
+                for ring in polygon
+            ]
+            for polygon in feature_polygons
+            if polygon
+        ]
+
+        precinct = feature['properties'][ID_PROPERTY]
+        geometries.append({
+            'type': 'MultiPolygon' if len(arc_polygons) > 1 else 'Polygon',
+            'arcs': arc_polygons if len(arc_polygons) > 1 else arc_polygons[0],
+            'id': precinct,
+            'properties': {ID_PROPERTY: precinct}
+        })
+
+    return {
+        'origin': origin,
+        'scale': scale,
+        'arcs': arcs,
+        'geometries': geometries
+    }
+
+def topojson_level(topology, tolerance):
+    return {
+        'type': 'Topology',
+        'bbox': [
+            *topology['origin'].tolist(),
+            *(topology['origin'] + topology['scale'] * (QUANTIZATION - 1)).tolist()
+        ],
+        'transform': {
+            'scale': topology['scale'].tolist(),
+            'translate': topology['origin'].tolist()
+        },
+        'objects': {
+            OBJECT_NAME: {
+                'type': 'GeometryCollection',
+                'geometries': topology['geometries']
+            }
+        },
+        'arcs': [delta_encode(simplify_arc(arc, tolerance)) for arc in topology['arcs']]
+    }
+
+def demographics_table(features):
+    return [
+        {
+            'command_normalized': str(feature['properties'][ID_PROPERTY]),
+            **{
+                name: round(value, 4) if isinstance(value, float) else value
+                for name, value in feature['properties'].items()
+                if name != ID_PROPERTY
+            }
+        }
+        for feature in features
+    ]
+
+def write_hashed(output_dir, stem, suffix, content):
+    payload = json.dumps(content, separators=(',', ':')).encode()
+    file_name = f'{stem}.{hashlib.sha256(payload).hexdigest()[:12]}{suffix}'
+
+    with open(os.path.join(output_dir, file_name), 'wb') as f:
+        f.write(payload)
+
+    return file_name, len(payload)
+
+def build_precinct_topojson(source=DEFAULT_SOURCE, output_dir=DEFAULT_OUTPUT_DIR):
+    with open(source) as f:
+        features = json.load(f)['features']
+
+    topology = build_topology(features)
+
+    # quantized units per pixel when the map spans max_width pixels
+    units_per_pixel = QUANTIZATION / np.array(SIMPLIFICATION_LEVELS[:-1], dtype=float)
+
+    levels = []
+    for max_width, tolerance in zip(SIMPLIFICATION_LEVELS, [*(units_per_pixel / 2), 0]):
+        file_name, size = write_hashed(output_dir, OBJECT_NAME, '.topo.json', topojson_level(topology, tolerance))
+        levels.append({
+            'max_width': max_width,
+            'file': file_name,
+            'bytes': size
+        })
+        print(f"{file_name}: {size:,} bytes (up to {max_width or 'any'} px)")
+
+    demographics = demographics_table(features)
+    demographics_file, size = write_hashed(output_dir, f'{OBJECT_NAME}_demographics', '.json', demographics)
+    print(f'{demographics_file}: {size:,} bytes')
+
+    # clear out files from earlier builds the new manifest no longer lists
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        current = {level['file'] for level in levels} | {demographics_file}
+        for file_name in [level['file'] for level in previous['levels']] + [previous['demographics']['file']]:
+            if file_name not in current and os.path.exists(os.path.join(output_dir, file_name)):
+                os.remove(os.path.join(output_dir, file_name))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(
+            {
+                'object': OBJECT_NAME,
+                'levels': levels,
+                'demographics': {
+                    'file': demographics_file,
+                    'fields': [name for name in demographics[0] if name != 'command_normalized']
+                }
+            },
+            f,
+            indent=2
+        )
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build quantized, shared-arc TopoJSON precinct boundaries and a demographics table for the app.'
+    )
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help=f'precinct GeoJSON with census properties (default: {DEFAULT_SOURCE})')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help=f'static directory served by the app (default: {DEFAULT_OUTPUT_DIR})')
+    args = parser.parse_args()
+
+    build_precinct_topojson(args.source, args.output_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from quantile_sketch import KLLSketch, merge_sketches
+from rollups import group_index
+
+## cases cube
+# the cases are aggregated once into (occurrence_year, command_normalized,
+# has_settlement) cells holding the case count and payout total, so any year
+# window with or without the settlement filter is a slice of the cells
+# followed by a sum per command.
+#
+# medians can't be summed, so each cell also keeps its payouts sorted, stored
+# back to back in one array with the cell's [start, stop) offsets. A window's
+# median per command merges the presorted runs of its cells (NumPy's stable
+# sort on floats is a timsort, which merges existing runs rather than sorting
+# from scratch).
+#
+# merging every payout gets expensive over decades of litigation, so each cell
+# also carries a KLL quantile sketch of its payouts. A command whose selected
+# cells hold more than exact_up_to payouts gets its percentiles by merging the
+# cells' sketches instead; below that they are exact.
+#
+# cases without a command stay in the cube (as a NaN command) so the count of
+# selected cases matches the row count; they're left out of the per-command
+# summary as the groupby always did.
+#
+# the summary can also be taken per group of commands (see rollups.py): the
+# cells are grouped by their commands' groups, so a group's percentiles merge
+# its commands' payouts like a command's merge its years'.
+
+CasesCube = namedtuple(
+    'CasesCube',
+    [
+        'cells',
+        'payouts'
+    ]
+)
+
+# column suffix -> quantile of the selected payouts
+PAYOUT_QUANTILES = {
+    'median': 0.5,
+    'p90': 0.9,
+    'p99': 0.99
+}
+
+EXACT_PAYOUTS_UP_TO = 100_000
+
+CUBE_KEYS = [
+    'occurrence_year',
+    'command_normalized',
+    'has_settlement'
+]
+
+def build_cases_cube(cases):
+    cases = (
+        cases
+        [['occurrence_year','command_normalized','Total City Payout AMT']]
+        .dropna(subset='occurrence_year')
+        .assign(
+            has_settlement = lambda row: row['Total City Payout AMT'] > 0
+        )
+        .sort_values(CUBE_KEYS + ['Total City Payout AMT'], na_position='last')
+    )
+
+    cells = (
+        cases
+        .groupby(CUBE_KEYS, observed=True, dropna=False, sort=True)
+        .agg(
+            count_cases = pd.NamedAgg('Total City Payout AMT', 'size'),
+            count_payouts = pd.NamedAgg('Total City Payout AMT', 'count'),
+            payout_total = pd.NamedAgg('Total City Payout AMT', 'sum')
+        )
+    )
+
+    # rows are sorted by the cube keys, so each cell's payouts are a
+    # contiguous run with its missing amounts at the end
+    cell_starts = np.concatenate([[0], np.cumsum(cells['count_cases'].to_numpy())[:-1]])
+
+    cell_stops = cell_starts + cells['count_payouts'].to_numpy()
+    payouts = cases['Total City Payout AMT'].to_numpy()
+
+    return CasesCube(
+        cells=cells.assign(
+            payouts_start = cell_starts,
+            payouts_stop = cell_stops,
+            # each cell's compactions get their own coins
+            payout_sketch = [
+                KLLSketch.from_values(payouts[start:stop], seed=cell_number)
+                for cell_number, (start, stop) in enumerate(zip(cell_starts, cell_stops))
+            ]
+        ),
+        payouts=payouts
+    )
+
+def select_cells(cases_cube, case_years, with_settlement_only):
+    cells = cases_cube.cells
+    occurrence_years = cells.index.get_level_values('occurrence_year')
+
+    selected = (occurrence_years >= case_years[0]) & (occurrence_years <= case_years[1])
+    if with_settlement_only:
+        selected &= cells.index.get_level_values('has_settlement')
+
+    return cells[selected]
+
+def count_selected_cases(cases_cube, case_years, with_settlement_only):
+    return int(select_cells(cases_cube, case_years, with_settlement_only)['count_cases'].sum())
+
+def merged_quantiles(cases_cube, cells, quantiles, exact_up_to=EXACT_PAYOUTS_UP_TO):
+    count_payouts = cells['count_payouts'].sum()
+
+    if count_payouts == 0:
+        return np.full(len(quantiles), np.nan)
+
+    if count_payouts > exact_up_to:
+        return merge_sketches(cells['payout_sketch']).quantiles(quantiles)
+
+    payouts = np.sort(
+        np.concatenate([
+            cases_cube.payouts[start:stop]
+            for start, stop in zip(cells['payouts_start'], cells['payouts_stop'])
+        ]),
+        kind='stable'
+    )
+
+    # linear interpolation between order statistics, as pandas' median and
+    # quantile do
+    return np.quantile(payouts, quantiles)
+
+def summarize_by_command(cases_cube, case_years, with_settlement_only, exact_up_to=EXACT_PAYOUTS_UP_TO, groups=None):
+    cells = select_cells(cases_cube, case_years, with_settlement_only)
+
+    if groups is None:
+        cells = cells.loc[cells.index.get_level_values('command_normalized').notna()]
+        by_command = cells.groupby('command_normalized', observed=True)
+    else:
+        group_labels, has_group = group_index(cells.index, groups)
+        by_command = cells[has_group].groupby(group_labels, observed=True)
+
+    payout_quantiles = np.array(
+        [
+            merged_quantiles(cases_cube, command_cells, list(PAYOUT_QUANTILES.values()), exact_up_to)
+            for _, command_cells in by_command
+        ]
+    ).reshape(-1, len(PAYOUT_QUANTILES))
+
+    return (
+        by_command
+        [['count_cases','payout_total']]
+        .sum()
+        .assign(**{
+            f'payout_{name}': payout_quantiles[:, i]
+            for i, name in enumerate(PAYOUT_QUANTILES)
+        })
+    )
@@ -0,0 +1,692 @@
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from allegations_store import read_allegations, scan_allegations, source_commands, store_commands
+from cases_cube import build_cases_cube, select_cells as select_cases_cells, summarize_by_command as summarize_cases_by_command
+import change_engine
+from command_registry import build_command_registry, command_ids, geographic_mask, values_by_id
+from complaints_cube import FADO_TYPES, complaint_memberships, count_by_period_by_command, cube_from_memberships, count_by_year_by_command as count_from_cube, period_label, periods_per_year
+from rollups import COMMAND_LEVEL, command_groups, covered_groups, normalize_rolled_up, roll_up_complaints, roll_up_normalized
+
+## CCRB complaints and cases analysis, without the UI
+# the loaders and computations behind parameterized_find_increasing_ccrb.py
+# as plain functions of data and parameters. The app wraps each of them in
+# its Streamlit caches; Code/batch_reports.py runs them headless over grids
+# of parameters.
+
+CCRB_ALLEGATIONS_PATH = 'Data/Processed Data/ccrb_allegations_with_labels.parquet'
+ALLEGATIONS_STORE_PATH = 'Data/Processed Data/ccrb_allegations.arrow'
+OFFICERS_BY_COMMAND_PATH = 'Data/Processed Data/active_officers_by_command.parquet'
+INDEX_CRIMES_PATH = 'Data/Processed Data/index_crimes_by_precinct_2024.csv'
+CASES_PATH = 'Data/Processed Data/cases_dates_locations.parquet'
+
+# range of the complaint year sliders
+COMPLAINT_YEARS = (2000, 2024)
+
+NORMALIZERS = (
+    'None',
+    'Currently active officers',
+    '2024 Index crimes'
+)
+
+## loading
+
+def load_command_dictionary():
+    # one categorical dtype for command_normalized shared by every loader, so
+    # joins across CCRB, roster, crimes and cases compare integer codes
+
+    # the allegations' commands come from the store's dictionary when it's
+    # built, rather than a scan of the whole column
+    allegation_commands = (
+        store_commands(ALLEGATIONS_STORE_PATH) if os.path.exists(ALLEGATIONS_STORE_PATH)
+        else source_commands(CCRB_ALLEGATIONS_PATH)
+    )
+
+    commands = pd.concat([
+        pd.Series(allegation_commands, dtype=object),
+        pd.read_parquet(OFFICERS_BY_COMMAND_PATH, columns=[]).index.to_series(),
+        pd.read_csv(INDEX_CRIMES_PATH, usecols=['precinct'], dtype={'precinct':str})['precinct'],
+        pd.read_parquet(CASES_PATH, columns=['command_normalized'])['command_normalized']
+    ])
+
+    return pd.CategoricalDtype(
+        sorted(commands.dropna().astype(str).unique())
+    )
+
+def load_ccrb(command_dictionary):
+
+    # built from the NYC Open Data CCRB allegations and complaints CSV exports
+    # by Code/build_ccrb_dataset.py, which also writes the memory-mapped store
+
+    columns = [
+        'Complaint Id',
+        'Incident Date',
+        'command_normalized',
+        'FADO Type',
+        'CCRB disposition substantiated'
+    ]
+
+    # the complaints cube covers every setting of the widgets, so the
+    # selection is their full domains: complaint years within the sliders'
+    # range, of a selectable FADO type. The store skips the record batches
+    # outside it without reading them; the parquet fallback filters the same
+    # rows, so both hold the same complaints
+    if os.path.exists(ALLEGATIONS_STORE_PATH):
+        ccrb_allegations = scan_allegations(
+            ALLEGATIONS_STORE_PATH,
+            years=COMPLAINT_YEARS,
+            fado_types=FADO_TYPES,
+            columns=columns
+        )
+    else:
+        ccrb_allegations = read_allegations(
+            CCRB_ALLEGATIONS_PATH,
+            years=COMPLAINT_YEARS,
+            fado_types=FADO_TYPES,
+            columns=columns
+        )
+
+    # the incident year and month are taken off the dates in Arrow, so the
+    # dates themselves are never copied into pandas
+    incident_dates = ccrb_allegations['Incident Date']
+    ccrb_allegations = (
+        ccrb_allegations
+        .drop_columns(['Incident Date'])
+        .append_column('incident_year', pc.year(incident_dates).cast(pa.int16()))
+        .append_column('incident_month', pc.month(incident_dates).cast(pa.int8()))
+        .to_pandas(types_mapper={pa.int16(): pd.Int16Dtype(), pa.int8(): pd.Int8Dtype()}.get)
+    )
+
+    ccrb_allegations = ccrb_allegations.assign(
+        **{
+            'Complaint Id': pd.to_numeric(ccrb_allegations['Complaint Id'], downcast='integer'),
+            'command_normalized': ccrb_allegations['command_normalized'].astype(str).astype(command_dictionary),
+            'FADO Type': ccrb_allegations['FADO Type'].astype('category'),
+            'CCRB disposition substantiated': ccrb_allegations['CCRB disposition substantiated'].fillna(False).astype(bool)
+        }
+    )
+
+    return ccrb_allegations
+
+def load_officers_by_command(command_dictionary):
+    # roster = pd.read_csv(
+    #     'https://data.cityofnewyork.us/api/views/2fir-qns4/rows.csv?date=20231205&accessType=DOWNLOAD',
+    #     parse_dates=['Last Reported Active Date'],
+    #     true_values=['Yes'],
+    #     false_values=['No'],
+    #     dtype={'Tax ID':str}
+    # )
+
+    # roster = (
+    #     roster
+    #     .assign(
+    #         command_normalized = normalize_commands(
+    #             roster['Current Command']
+    #         )
+    #     )
+    # )
+
+    # active_officers_by_command = (
+    #     roster
+    #     [
+    #         roster['Active Per Last Reported Status']
+    #     ]
+    #     .groupby('command_normalized')
+    #     ['Tax ID']
+    #     .nunique()
+    # )
+
+    active_officers_by_command = (
+        pd.read_parquet(OFFICERS_BY_COMMAND_PATH, columns=['count_officers'])
+        ['count_officers']
+        # the roster lists some commands (e.g. EMERGENCY SERVICES UNIT) more
+        # than once
+        .groupby(level='command_normalized')
+        .sum()
+        .pipe(pd.to_numeric, downcast='integer')
+    )
+
+    active_officers_by_command.index = active_officers_by_command.index.astype(command_dictionary)
+
+    return active_officers_by_command
+
+def load_index_crimes(command_dictionary):
+    return (
+        pd.read_csv(
+            INDEX_CRIMES_PATH,
+            dtype={
+                'precinct':command_dictionary,
+                'index_crimes_2024':'int32'
+            }
+        )
+        .rename(columns={'precinct':'command_normalized'})
+        .set_index('command_normalized')
+        ['index_crimes_2024']
+    )
+
+def load_cases(command_dictionary):
+    cases = pd.read_parquet(
+        CASES_PATH,
+        columns=[
+            'Date of Occurrence',
+            'Total City Payout AMT',
+            'command_normalized'
+        ]
+    )
+
+    return cases.assign(
+        command_normalized = cases['command_normalized'].astype(command_dictionary),
+        occurrence_year = cases['Date of Occurrence'].dt.year.astype('Int16')
+    )
+
+# everything the computations read, already aggregated
+Datasets = namedtuple(
+    'Datasets',
+    [
+        'command_registry',
+        'complaints_cube',
+        # the rows the complaints cube is built from, to build the cubes of
+        # the aggregation levels' groups
+        'complaint_memberships',
+        'officers_by_command',
+        'index_crimes',
+        'cases_cube'
+    ]
+)
+
+def load_datasets():
+    command_dictionary = load_command_dictionary()
+    memberships = complaint_memberships(load_ccrb(command_dictionary))
+
+    return Datasets(
+        command_registry=build_command_registry(command_dictionary),
+        complaints_cube=cube_from_memberships(memberships),
+        complaint_memberships=memberships,
+        officers_by_command=load_officers_by_command(command_dictionary),
+        index_crimes=load_index_crimes(command_dictionary),
+        cases_cube=build_cases_cube(load_cases(command_dictionary))
+    )
+
+## complaints
+
+def select_normalizer(normalize_by, officers_by_command, index_crimes):
+    return (
+        officers_by_command if normalize_by == 'Currently active officers'
+        else index_crimes if normalize_by == '2024 Index crimes'
+        else 1
+    )
+
+def normalize_complaints(count_by_year_by_command, normalizer):
+    if not isinstance(normalizer, pd.Series):
+        return (
+            count_by_year_by_command
+            .div(normalizer)
+            .rename('count_complaints')
+        )
+
+    # each row's normalizer picked by its command id
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = (
+            count_by_year_by_command.to_numpy()
+            / values_by_id(normalizer)[command_ids(count_by_year_by_command.index)]
+        )
+
+    return pd.Series(
+        normalized,
+        index=count_by_year_by_command.index,
+        name='count_complaints'
+    )
+
+def average_complaints_by_year(normalized_by_year_by_command):
+    return (
+        normalized_by_year_by_command
+        .unstack()
+        .mean(
+            axis=1,
+            skipna=True
+        )
+        .rename('count_complaints')
+    )
+
+def compare_periods(
+    complaints_matrix,
+    reference_years,
+    focus_years,
+    geographic_precincts_only,
+    aggregation_level,
+    command_registry
+):
+    change_by_precinct = change_engine.compare_periods(
+        complaints_matrix,
+        reference_years,
+        focus_years
+    )
+
+    if geographic_precincts_only and aggregation_level == COMMAND_LEVEL:
+        change_by_precinct = change_by_precinct[
+            geographic_mask(command_registry, change_by_precinct.index)
+        ]
+
+    return change_by_precinct
+
+def top_changes(change_by_precinct, k):
+    return change_engine.top_changes(change_by_precinct, k)
+
+def filter_to_threshold(change_by_precinct, complaints_matrix, reference_years, focus_years, minimum_instances_threshold):
+    return (
+        change_by_precinct
+        [
+            change_engine.threshold_mask(
+                complaints_matrix,
+                reference_years,
+                focus_years,
+                minimum_instances_threshold
+            )
+            .reindex(change_by_precinct.index, fill_value=False)
+        ]
+    )
+
+def rank_commands(complaints_matrix, commands, years, ranked_commands=None):
+    # annual rank among commands over the years shown, for the commands shown
+    return change_engine.rank_window(
+        complaints_matrix,
+        years,
+        commands,
+        ranked_commands
+    )
+
+def describe_level(aggregation_level):
+    return (
+        'by precinct' if aggregation_level == COMMAND_LEVEL
+        else 'citywide' if aggregation_level == 'Citywide'
+        else f'by {aggregation_level.lower()}'
+    )
+
+def describe_complaints(
+    fado_types,
+    substantiated_only,
+    normalize_by,
+    reference_years,
+    focus_years,
+    geographic_precincts_only,
+    minimum_instances_threshold,
+    aggregation_level
+):
+    return (
+        f"{'Substantiated' if substantiated_only else 'All'} complaints of type(s): {', '.join(fado_types)}",
+        f"{'per '+ normalize_by.lower() if normalize_by != 'None' else ''}",
+        f"{'Rolled up ' + describe_level(aggregation_level) if aggregation_level != COMMAND_LEVEL else ''}",
+        f"Comparing years {reference_years[0]}-{reference_years[1]} to {focus_years[0]}-{focus_years[1]}",
+        f"{'Showing only geographic precincts' if geographic_precincts_only > 0 else ''}",
+        f"{'Showing precincts/commands with at least ' + str(minimum_instances_threshold) + ' complaints in at least one year of each period' if minimum_instances_threshold > 0 else ''}"
+    )
+
+def label_change_by_precinct(change_by_precinct, reference_years, focus_years, aggregation_level):
+    # the whole table as shown and downloaded, largest change first
+    return (
+        change_engine.sort_changes(change_by_precinct)
+        [[
+            'pct_change',
+            'reference_years',
+            'focus_years'
+        ]]
+        .reset_index()
+        .rename(columns={
+            'command_normalized':aggregation_level,
+            'reference_years':f"{reference_years[0]}-{reference_years[1]} (annual mean)",
+            'focus_years':f"{focus_years[0]}-{focus_years[1]} (annual mean)",
+            'pct_change':'Pct change'
+        })
+        .set_index(aggregation_level)
+    )
+
+## cases
+
+def summarize_cases(cases_cube, case_years, with_settlement_only, normalizer, groups=None):
+    if groups is not None:
+        return summarize_rolled_up_cases(cases_cube, case_years, with_settlement_only, normalizer, groups)
+
+    cases_by_command = summarize_cases_by_command(cases_cube, case_years, with_settlement_only)
+
+    return (
+        (
+            cases_by_command
+            ['count_cases']
+            .div(normalizer)
+            .rename('Count of cases')
+            .to_frame()
+        )
+        .join(
+            (
+                cases_by_command
+                ['payout_total']
+                .div(normalizer)
+                .rename('Settlement grand total')
+            ),
+            how='outer'
+        )
+        .join(
+            (
+                cases_by_command
+                [['payout_median','payout_p90','payout_p99']]
+                .rename(columns={
+                    'payout_median':'Median settlement',
+                    'payout_p90':'90th percentile settlement',
+                    'payout_p99':'99th percentile settlement'
+                })
+            ),
+            how='outer'
+        )
+        # .sort_values(by=case_summary_selected, ascending=False)
+    )
+
+def summarize_rolled_up_cases(cases_cube, case_years, with_settlement_only, normalizer, groups):
+    # counts and totals summed per command then normalized per group, and
+    # percentiles over all of each group's payouts
+    cases_by_group = summarize_cases_by_command(cases_cube, case_years, with_settlement_only, groups=groups)
+    totals_by_command = (
+        select_cases_cells(cases_cube, case_years, with_settlement_only)
+        [['count_cases','payout_total']]
+        .groupby(level='command_normalized', observed=True)
+        .sum()
+    )
+
+    return (
+        roll_up_normalized(totals_by_command, normalizer, groups)
+        .rename(columns={
+            'count_cases':'Count of cases',
+            'payout_total':'Settlement grand total'
+        })
+        .join(
+            (
+                cases_by_group
+                [['payout_median','payout_p90','payout_p99']]
+                .rename(columns={
+                    'payout_median':'Median settlement',
+                    'payout_p90':'90th percentile settlement',
+                    'payout_p99':'99th percentile settlement'
+                })
+            ),
+            how='outer'
+        )
+    )
+
+def describe_cases(case_years, with_settlement_only, normalize_by, aggregation_level, geographic_precincts_only):
+    # geographic_precincts_only: whether only the precincts were rolled up
+    # (see rolls_up_geographic_only)
+    return (
+        "Count of cases, Settlement grand total",
+        f"{'per '+ normalize_by.lower() if normalize_by != 'None' else ''}",
+        "and Median (with 90th and 99th percentile) settlement",
+        describe_level(aggregation_level) + (' (geographic precincts only)' if geographic_precincts_only else ''),
+        f"From incidents that occurred {case_years[0]} - {case_years[1]}",
+        f"{'Showing only cases with settlement payment' if with_settlement_only else ''}"
+    )
+
+## aggregation levels
+# above the command level, complaints are counted from the complaints cube of
+# the groups of command_groups (see rollups.py), and
+# geographic_precincts_only picks the commands rolled up; at the command
+# level (groups None) it filters the change table instead, and leaves the
+# year x command matrix alone
+
+def rolls_up_geographic_only(aggregation_level, geographic_precincts_only):
+    return geographic_precincts_only and aggregation_level != COMMAND_LEVEL
+
+def select_groups(command_registry, aggregation_level, geographic_precincts_only):
+    if aggregation_level == COMMAND_LEVEL:
+        return None
+    return command_groups(command_registry, aggregation_level, geographic_precincts_only)
+
+def complaints_cube_at_level(complaints_cube, complaint_memberships, groups):
+    if groups is None:
+        return complaints_cube
+    return roll_up_complaints(complaint_memberships, groups)
+
+def count_at_level(datasets, fado_types, substantiated_only, groups):
+    return count_from_cube(
+        complaints_cube_at_level(datasets.complaints_cube, datasets.complaint_memberships, groups),
+        fado_types,
+        substantiated_only
+    )
+
+def normalizer_groups(groups, normalizer):
+    # the groups whose complaints are normalized: those of only the commands
+    # the normalizer covers
+    if groups is None:
+        return None
+    return covered_groups(groups, normalizer)
+
+def normalize_at_level(count_covered, normalizer, groups):
+    # count_covered: the counts at the level, from the cube of
+    # normalizer_groups(groups, normalizer)
+    if groups is None:
+        return normalize_complaints(count_covered, normalizer)
+    return normalize_rolled_up(count_covered, normalizer, groups).rename('count_complaints')
+
+## rolling windows
+# short-term changes, from counts by quarter or month: every trailing window
+# of periods compared with the window before it, or with the same window a
+# year earlier. The complaints cube is split by month, so the counts by
+# period are sums over it like the counts by year, and the period x command
+# matrix is the year x command one with more rows.
+
+ROLLING_GRANULARITIES = (
+    'Month',
+    'Quarter'
+)
+
+ROLLING_COMPARISONS = (
+    'Preceding window',
+    'Same window a year earlier'
+)
+
+def count_by_period(complaints_cube, fado_types, substantiated_only, granularity):
+    return count_by_period_by_command(complaints_cube, fado_types, substantiated_only, granularity)
+
+def comparison_lag(comparison, window_periods, granularity):
+    # periods between the ends of the focus and reference windows
+    if comparison == 'Same window a year earlier':
+        return periods_per_year(granularity)
+    return window_periods
+
+def rolling_changes(
+    period_matrix,
+    window_periods,
+    comparison,
+    granularity,
+    minimum_instances_threshold,
+    geographic_precincts_only,
+    aggregation_level,
+    command_registry
+):
+    rolling = change_engine.rolling_changes(
+        period_matrix,
+        window_periods,
+        comparison_lag(comparison, window_periods, granularity),
+        minimum_instances_threshold
+    )
+
+    if geographic_precincts_only and aggregation_level == COMMAND_LEVEL:
+        rolling = rolling[geographic_mask(command_registry, rolling.index)]
+
+    return rolling
+
+def latest_changes(rolling):
+    # the changes of the windows ending at the last period
+    if rolling.empty:
+        return rolling.droplevel(0)
+    periods = rolling.index.get_level_values(0)
+    return rolling[periods == periods.max()].droplevel(0)
+
+def describe_window(window_periods, granularity):
+    return f"{window_periods} {granularity.lower()}{'s' if window_periods > 1 else ''}"
+
+def describe_rolling(granularity, window_periods, comparison, minimum_instances_threshold, rolling):
+    latest = (
+        period_label(rolling.index.get_level_values(0).max(), granularity) if not rolling.empty
+        else 'none'
+    )
+    return (
+        f"Trailing {describe_window(window_periods, granularity)} compared to the {comparison.lower()}",
+        f"Windows ending {latest}",
+        f"{'Showing precincts/commands with at least ' + str(minimum_instances_threshold) + ' complaints in at least one ' + granularity.lower() + ' of each window' if minimum_instances_threshold > 0 else ''}"
+    )
+
+def label_latest_changes(latest, granularity, window_periods, aggregation_level):
+    return (
+        change_engine.sort_changes(latest)
+        [[
+            'pct_change',
+            'reference_years',
+            'focus_years'
+        ]]
+        .reset_index()
+        .rename(columns={
+            'command_normalized':aggregation_level,
+            'reference_years':f"Earlier {describe_window(window_periods, granularity)} ({granularity.lower()}ly mean)",
+            'focus_years':f"Trailing {describe_window(window_periods, granularity)} ({granularity.lower()}ly mean)",
+            'pct_change':'Pct change'
+        })
+        .set_index(aggregation_level)
+    )
+
+## outputs
+# the tables behind the app's downloads. The CSVs head each table with a
+# params column describing the settings they were computed with; the Excel
+# and Parquet files carry the params alongside the tables instead
+
+def complaints_pct_change_table(change_by_precinct_labeled):
+    return (
+        change_by_precinct_labeled
+        .reset_index()
+    )
+
+def complaints_annual_detail_table(normalized_by_year_by_command, aggregation_level):
+    return (
+        normalized_by_year_by_command
+        .rename_axis(index=['Year',aggregation_level])
+        .unstack('Year')
+        .reset_index()
+    )
+
+def cases_summary_table(cases_summary, aggregation_level):
+    return (
+        cases_summary
+        .reset_index()
+        .rename(columns={
+            'command_normalized':aggregation_level,
+        })
+    )
+
+def with_params(table, params):
+    return (
+        pd.concat([
+            pd.Series(
+                params,
+                name='params'
+            ),
+            table
+        ],axis=1)
+    )
+
+def complaints_pct_change_output(change_by_precinct_labeled, complaints_params):
+    return with_params(complaints_pct_change_table(change_by_precinct_labeled), complaints_params)
+
+def complaints_annual_detail_output(normalized_by_year_by_command, aggregation_level, complaints_params):
+    return with_params(complaints_annual_detail_table(normalized_by_year_by_command, aggregation_level), complaints_params)
+
+def cases_summary_output(cases_summary, aggregation_level, cases_params):
+    return with_params(cases_summary_table(cases_summary, aggregation_level), cases_params)
+
+## one report
+
+# the per-complaint-selection aggregates every year window is computed from
+ComplaintSelection = namedtuple(
+    'ComplaintSelection',
+    [
+        'normalizer',
+        # None at the command level, else each command's group
+        'groups',
+        'normalized_by_year_by_command',
+        'matrix'
+    ]
+)
+
+def select_complaints(
+    datasets,
+    fado_types,
+    substantiated_only,
+    normalize_by,
+    aggregation_level,
+    geographic_precincts_only
+):
+    # geographic_precincts_only only matters above the command level, where
+    # it picks the commands rolled up
+    groups = select_groups(datasets.command_registry, aggregation_level, geographic_precincts_only)
+    normalizer = select_normalizer(normalize_by, datasets.officers_by_command, datasets.index_crimes)
+
+    count_by_year_by_command = count_at_level(datasets, fado_types, substantiated_only, groups)
+    covered = normalizer_groups(groups, normalizer)
+    normalized_by_year_by_command = normalize_at_level(
+        count_by_year_by_command if covered is groups else count_at_level(datasets, fado_types, substantiated_only, covered),
+        normalizer,
+        groups
+    )
+
+    return ComplaintSelection(
+        normalizer=normalizer,
+        groups=groups,
+        normalized_by_year_by_command=normalized_by_year_by_command,
+        matrix=change_engine.to_year_command_matrix(
+            count_by_year_by_command,
+            normalized_by_year_by_command
+        )
+    )
+
+def compute_report(
+    datasets,
+    complaint_selection,
+    normalize_by,
+    reference_years,
+    focus_years,
+    geographic_precincts_only,
+    minimum_instances_threshold,
+    case_years,
+    with_settlement_only,
+    aggregation_level
+):
+    # the tables behind the app's complaints pct change and cases summary
+    # downloads, for one setting of every widget. complaint_selection comes
+    # from select_complaints with the same normalize_by and level, so callers
+    # running many windows over one selection build it once
+    change_by_precinct = filter_to_threshold(
+        compare_periods(
+            complaint_selection.matrix,
+            reference_years,
+            focus_years,
+            geographic_precincts_only,
+            aggregation_level,
+            datasets.command_registry
+        ),
+        complaint_selection.matrix,
+        reference_years,
+        focus_years,
+        minimum_instances_threshold
+    )
+
+    return {
+        'complaints_pct_change': change_by_precinct,
+        'cases_summary': summarize_cases(
+            datasets.cases_cube,
+            case_years,
+            with_settlement_only,
+            complaint_selection.normalizer,
+            complaint_selection.groups
+        )
+    }
@@ -0,0 +1,316 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+## reference vs focus change engine
+# holds complaint counts and their normalized values as dense years x commands
+# matrices with prefix sums along the years, so the annual mean and the
+# instance threshold for any year window come from two rows of a cumulative
+# sum instead of a .loc slice and a groupby per window. Window maxima (for the
+# instance threshold) come from a sparse table of maxima over power-of-two
+# runs of years, answered by the two runs that cover the window.
+#
+# pandas only averages the years a command actually has complaints in (absent
+# years aren't zeros), so alongside the values the matrix tracks which cells
+# were observed and averages over those.
+#
+# annual ranks are read off the same matrix, for the years of one window and
+# among a given set of commands: per year an argsort gives every command's
+# 'min' rank, or, for the handful of commands a chart shows, each one's rank
+# is one plus the number of larger values that year, which needs no sort at
+# all. top_k picks the k largest of a vector with a partial sort
+# (argpartition) and sorts only those k.
+#
+# the change table comes out in command order; top_changes takes the
+# commands with the largest changes from it the same way, and only a view of
+# the whole table (the app's table, the downloads) sorts it, by sort_changes.
+#
+# the matrix's rows are whatever consecutive periods the counts are indexed
+# by: years, or the quarters or months of the complaints cube's periods.
+# rolling_changes runs compare_periods for every trailing window of periods
+# at once, the windows' rows being arrays of prefix sum rows rather than two
+# integers.
+
+YearCommandMatrix = namedtuple(
+    'YearCommandMatrix',
+    [
+        'years',
+        'commands',
+        'counts',
+        # normalized values, NaN where a command has none that year
+        'values',
+        'observed',
+        # prefix sums along the years, with a leading row of zeros
+        'cumulative_values',
+        'cumulative_valid',
+        'cumulative_observed',
+        # sparse_max_counts[k][i] is the max count over years i .. i + 2**k - 1,
+        # -inf where the command has no complaints
+        'sparse_max_counts'
+    ]
+)
+
+def prefix_sum(matrix):
+    return np.concatenate(
+        [
+            np.zeros((1, matrix.shape[1]), dtype=matrix.dtype),
+            np.cumsum(matrix, axis=0)
+        ],
+        axis=0
+    )
+
+def sparse_max(matrix):
+    levels = [matrix]
+    length = 1
+    while 2 * length <= matrix.shape[0]:
+        previous = levels[-1]
+        levels.append(np.maximum(previous[:-length], previous[length:]))
+        length *= 2
+    return levels
+
+def read_only(array):
+    array.flags.writeable = False
+    return array
+
+def to_year_command_matrix(count_by_year_by_command, normalized_by_year_by_command):
+    # the arrays are made read-only, as the app shares one matrix across
+    # sessions
+    counts = count_by_year_by_command.unstack('command_normalized')
+    values = normalized_by_year_by_command.unstack('command_normalized')
+
+    if counts.empty:
+        years = pd.Index([], dtype=int, name=counts.index.name)
+    else:
+        years = pd.RangeIndex(
+            counts.index.min(),
+            counts.index.max() + 1,
+            name=counts.index.name
+        )
+
+    commands = counts.columns[counts.notna().any()]
+
+    counts = counts.reindex(index=years, columns=commands).to_numpy(dtype=float)
+    values = values.reindex(index=years, columns=commands).to_numpy(dtype=float)
+
+    observed = ~np.isnan(counts)
+    valid = ~np.isnan(values)
+
+    return YearCommandMatrix(
+        years=years,
+        commands=commands,
+        counts=read_only(np.nan_to_num(counts, nan=0)),
+        values=read_only(values),
+        observed=read_only(observed),
+        # the running totals are carried in extended precision so a window's
+        # total (a difference of two of them) rounds to the same double as
+        # summing the window directly, and equal means still compare equal
+        cumulative_values=read_only(prefix_sum(np.where(valid, values, 0).astype(np.longdouble))),
+        cumulative_valid=read_only(prefix_sum(valid.astype(np.int32))),
+        cumulative_observed=read_only(prefix_sum(observed.astype(np.int32))),
+        sparse_max_counts=[
+            read_only(level)
+            for level in sparse_max(np.where(observed, counts, -np.inf))
+        ]
+    )
+
+def window_rows(matrix, window):
+    # half-open row range of the prefix sums covering the years in window
+    if len(matrix.years) == 0:
+        return 0, 0
+
+    first_year = matrix.years[0]
+    start = int(np.clip(window[0] - first_year, 0, len(matrix.years)))
+    stop = int(np.clip(window[1] - first_year + 1, start, len(matrix.years)))
+    return start, stop
+
+def window_total(cumulative, rows):
+    start, stop = rows
+    return cumulative[stop] - cumulative[start]
+
+def window_mean(matrix, window):
+    rows = window_rows(matrix, window)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (
+            window_total(matrix.cumulative_values, rows).astype(float)
+            / window_total(matrix.cumulative_valid, rows)
+        )
+
+def window_observed(matrix, window):
+    return window_total(matrix.cumulative_observed, window_rows(matrix, window)) > 0
+
+def window_max(matrix, window):
+    start, stop = window_rows(matrix, window)
+    if stop == start:
+        return np.full(len(matrix.commands), -np.inf)
+
+    level = (stop - start).bit_length() - 1
+    maxima = matrix.sparse_max_counts[level]
+    return np.maximum(maxima[start], maxima[stop - (1 << level)])
+
+def compare_periods(matrix, reference_years, focus_years):
+    # commands with complaints in the reference years, as the left join of
+    # reference means onto focus means did
+    in_reference = window_observed(matrix, reference_years)
+
+    reference_mean = np.nan_to_num(window_mean(matrix, reference_years), nan=0, posinf=np.inf, neginf=-np.inf)
+    # commands without focus-year complaints average to 0/0, like the
+    # missing right side of the join
+    focus_mean = np.nan_to_num(window_mean(matrix, focus_years), nan=0, posinf=np.inf, neginf=-np.inf)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct_change = focus_mean / reference_mean - 1
+
+    keep = in_reference & ~np.isnan(pct_change)
+
+    return (
+        pd.DataFrame(
+            {
+                'reference_years': reference_mean[keep],
+                'focus_years': focus_mean[keep],
+                'pct_change': pct_change[keep]
+            },
+            index=matrix.commands[keep]
+        )
+    )
+
+def threshold_mask(matrix, reference_years, focus_years, minimum_instances_threshold):
+    # a command passes when some year of each window has at least the
+    # threshold's complaints; years without complaints never count, even
+    # against a threshold of 0
+    return pd.Series(
+        (
+            (window_max(matrix, reference_years) >= minimum_instances_threshold)
+            & (window_max(matrix, focus_years) >= minimum_instances_threshold)
+        ),
+        index=matrix.commands
+    )
+
+def rolling_changes(matrix, window_periods, lag_periods, minimum_instances_threshold):
+    # compare_periods and threshold_mask for the window of window_periods
+    # periods ending at each period (the focus) against the window ending
+    # lag_periods earlier (the reference), e.g. the trailing 12 months
+    # against the 12 months before them, or against the same 12 months a
+    # year earlier with a lag of 12 as well; only the periods with a full
+    # reference window. A (period, command) frame of the passing changes.
+    first = lag_periods + window_periods - 1
+    ends = np.arange(first, len(matrix.years))
+    if len(ends) == 0:
+        return pd.DataFrame(
+            {'reference_years': [], 'focus_years': [], 'pct_change': []},
+            index=pd.MultiIndex.from_arrays([matrix.years[:0], matrix.commands[:0]])
+        )
+
+    focus_rows = ends - window_periods + 1, ends + 1
+    reference_rows = focus_rows[0] - lag_periods, focus_rows[1] - lag_periods
+
+    def mean(rows):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.nan_to_num(
+                window_total(matrix.cumulative_values, rows).astype(float)
+                / window_total(matrix.cumulative_valid, rows),
+                nan=0, posinf=np.inf, neginf=-np.inf
+            )
+
+    def window_max(rows):
+        level = window_periods.bit_length() - 1
+        maxima = matrix.sparse_max_counts[level]
+        return np.maximum(maxima[rows[0]], maxima[rows[1] - (1 << level)])
+
+    reference_mean = mean(reference_rows)
+    focus_mean = mean(focus_rows)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pct_change = focus_mean / reference_mean - 1
+
+    keep = (
+        (window_total(matrix.cumulative_observed, reference_rows) > 0)
+        & ~np.isnan(pct_change)
+        & (window_max(reference_rows) >= minimum_instances_threshold)
+        & (window_max(focus_rows) >= minimum_instances_threshold)
+    )
+    periods, columns = np.nonzero(keep)
+
+    return pd.DataFrame(
+        {
+            'reference_years': reference_mean[keep],
+            'focus_years': focus_mean[keep],
+            'pct_change': pct_change[keep]
+        },
+        index=pd.MultiIndex.from_arrays(
+            [matrix.years[ends[periods]], matrix.commands[columns]]
+        )
+    )
+
+def min_rank(values):
+    # rank of each row's values, largest first, ties sharing the smallest
+    # rank and NaN left unranked: rank(axis=1, method='min', ascending=False)
+    order = np.argsort(-values, axis=1, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+
+    positions = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    run_starts = np.ones(values.shape, dtype=bool)
+    run_starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+
+    sorted_ranks = np.maximum.accumulate(np.where(run_starts, positions, 0), axis=1) + 1.0
+    sorted_ranks[np.isnan(sorted_values)] = np.nan
+
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks
+
+def min_rank_of(values, columns):
+    # the same ranks for a few columns only: one plus the count of larger
+    # values in the row (comparisons with NaN count nothing)
+    selected = values[:, columns]
+    ranks = 1.0 + (values[:, None, :] > selected[:, :, None]).sum(axis=2)
+    ranks[np.isnan(selected)] = np.nan
+    return ranks
+
+def top_k(values, k):
+    # positions of the k largest values, largest first (ties in position
+    # order, as a stable descending sort has them); NaN never makes the cut
+    candidates = np.flatnonzero(~np.isnan(values))
+    if k <= 0:
+        return candidates[:0]
+
+    if k < len(candidates):
+        kth_largest = values[candidates[np.argpartition(-values[candidates], k - 1)[k - 1]]]
+        above = candidates[values[candidates] > kth_largest]
+        tied = candidates[values[candidates] == kth_largest][:k - len(above)]
+        candidates = np.sort(np.concatenate([above, tied]))
+
+    return candidates[np.argsort(-values[candidates], kind='stable')]
+
+def rank_window(matrix, window, commands, ranked_commands=None):
+    # each year's rank of ranked_commands (default: all of commands) among
+    # commands, for the years in window; a (year, command) series without
+    # the cells a command has no value in
+    start, stop = window_rows(matrix, window)
+    columns = matrix.commands.get_indexer(commands)
+    columns = np.sort(columns[columns >= 0])
+    values = matrix.values[start:stop, columns]
+
+    if ranked_commands is None:
+        ranked = np.arange(len(columns))
+        ranks = min_rank(values)
+    else:
+        ranked = np.flatnonzero(matrix.commands[columns].isin(ranked_commands))
+        ranks = min_rank_of(values, ranked)
+
+    index = pd.MultiIndex.from_product(
+        [matrix.years[start:stop], matrix.commands[columns[ranked]]]
+    )
+    ranks = ranks.ravel()
+    keep = ~np.isnan(ranks)
+
+    return pd.Series(ranks[keep], index=index[keep], name='rank')
+
+def top_changes(change_by_command, k):
+    # the k rows with the largest pct_change, largest first
+    return change_by_command.iloc[top_k(change_by_command['pct_change'].to_numpy(), k)]
+
+def sort_changes(change_by_command):
+    return change_by_command.sort_values('pct_change', ascending=False, kind='stable')
+
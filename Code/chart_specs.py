@@ -0,0 +1,68 @@
+import json
+
+import altair as alt
+
+## serialized Vega-Lite specs
+# validating and serializing an Altair chart is a large share of a rerun, so
+# the app serializes each column of the linked viz on its own (cached on the
+# parameters the column is drawn from) and stitches the columns' JSON
+# together here, instead of serializing the whole concat every rerun.
+#
+# Altair lifts a compound chart's selection params to its top level with the
+# list of views they're bound to, and moves inline data to top-level named
+# datasets; concatenating the columns merges those the same way. This only
+# links the columns' selections if they share a name, so selections drawn
+# across columns must be named explicitly (Altair's generated param_N names
+# differ between builds).
+#
+# data and transform given to concat_specs sit at the top of the
+# concatenation, where every view without data of its own inherits them: the
+# maps share one geometry source, fetched, parsed and joined once. Columns
+# are serialized with that same data (otherwise Altair gives their data-less
+# views an empty inline dataset), which is dropped here so they inherit it.
+
+def chart_to_json(chart):
+    # no default theme, as st.altair_chart serializes charts (Streamlit
+    # applies its own theme and sizing)
+    with alt.theme.enable('none'):
+        return json.dumps(chart.to_dict())
+
+def concat_specs(specs, direction='hconcat', config=None, data=None, transform=None):
+    concatenated = {
+        '$schema': None,
+        direction: [],
+        'params': [],
+        'datasets': {}
+    }
+    params_by_name = {}
+
+    for spec in map(json.loads, specs):
+        concatenated['$schema'] = spec.pop('$schema', concatenated['$schema'])
+        concatenated['datasets'].update(spec.pop('datasets', {}))
+
+        for param in spec.pop('params', []):
+            if param['name'] in params_by_name:
+                params_by_name[param['name']]['views'] += param.get('views', [])
+            else:
+                params_by_name[param['name']] = param
+                concatenated['params'].append(param)
+
+        if data is not None and spec.get('data') == data:
+            del spec['data']
+
+        concatenated[direction].append(spec)
+
+    if data is not None:
+        concatenated['data'] = data
+
+    if transform is not None:
+        concatenated['transform'] = transform
+
+    if config is not None:
+        concatenated['config'] = config
+
+    for key in ['$schema','params','datasets']:
+        if not concatenated[key]:
+            del concatenated[key]
+
+    return json.dumps(concatenated)
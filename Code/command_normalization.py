@@ -0,0 +1,111 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+## command normalization
+# maps free-text command names from the CCRB and roster exports (e.g.
+# '075 PCT', '75TH PRECINCT', 'NARCOTICS BOROUGH BRONX') to the keys used
+# throughout the app ('75', 'NARCBBX')
+#
+# the aliases are applied in order, and the order matters (e.g. 'BROOKLYN
+# SOUTH NARCOTICS' is rewritten before 'BROOKLYN SOUTH NARCOTICS DISTRICT'
+# could match, and 'PRECINCT' is removed before 'PRE'), so the table is
+# compiled once and run over each distinct command string rather than
+# collapsed into a single alternation that would change results.
+
+# (pattern, replacement, is_regex)
+COMMAND_ALIASES = [
+    (r'(?<=\d) *TH', '', True),
+    (r'(?<=\d) *ND', '', True),
+    (r'(?<=\d) *RD', '', True),
+    (r'PCT[\. ]*', '', True),
+    ('CMD', '', False),
+    ('PRECINCT', '', False),
+    ('PRE', '', False),
+    ('DET(ECTIVE)*', '', True),
+    ('COMMAND', '', False),
+    ('SQUAD', '', False),
+    ('MTS', '14', False),
+    ('MIDTOWN SOUTH', '14', False),
+    ('MTN', '18', False),
+    ('MIDTOWN NORTH', '18', False),
+    ('CPK', '22', False),
+    ('POLICE SERVICE AREA', 'PSA', False),
+    ('E.S.U.', 'E S U', False),
+    ('NARC BBX', 'NARCBBX', False),
+    ('NARCOTICS BOROUGH BRONX', 'NARCBBX', False),
+    ('NARCBBN DIVISION', 'NARCBBN', False),
+    ('BROOKLYN NORTH NARCOTICS', 'NARCBBN', False),
+    ('NARCOTICS BOROUGH BROOKLYN NORTH', 'NARCBBN', False),
+    ('BNNARC', 'NARCBBN', False),
+    ('NARCBNN', 'NARCBBN', False),
+    ('BROOKLYN SOUTH NARCOTICS', 'NARCBBS', False),
+    ('NARC BBS', 'NARCBBS', False),
+    ('NARCOTICS BOROUGH BROOKLYN SOUTH', 'NARCBBS', False),
+    ('NARCOTICS BORO BROOKLYN SOUTH', 'NARCBBS', False),
+    ('BROOKLYN SOUTH NARCOTICS DISTRICT', 'NARCBBS', False),
+    ('NARCOTICS BORO STATEN ISLAND', 'NARCBSI', False),
+    ('NARCOTICS BOROUGH STATEN ISLAND', 'NARCBSI', False),
+    ('QS NARC', 'NARCBQS', False),
+    ('MANHATTAN SOUTH NARCOTICS DISTRICT', 'NARCBMS', False),
+    ('NARCOTICS BORO MANHATTAN NORTH', 'NARCBMN', False),
+    ('WARRANT SECTION', 'WARRSEC', False),
+    ('QS GANG', 'GANG QS', False),
+    ('MANHATTAN GANG', 'GANG M', False),
+    ('GANG MANHATTAN', 'GANG M', False),
+    ('QUEENS GANG', 'GANG Q', False),
+    ('STATEN ISLAND GANGS DIVISION', 'GANG SI', False),
+    ('GANG  BROOKLYN SOUTH', 'GANG BS', False),
+    ('BROOKLYN SOUTH GANG', 'GANG BS', False),
+    ('BROOKLYN SOUTH GANG UNIT', 'GANG BS', False),
+    ('BN GANG UNIT', 'GANG BN', False),
+]
+
+UNKNOWN_COMMANDS = {
+    'UNIDENTIFIED',
+    'UNKNOWN'
+}
+
+COMPILED_COMMAND_ALIASES = [
+    (re.compile(pattern if is_regex else re.escape(pattern)), replacement)
+    for pattern, replacement, is_regex in COMMAND_ALIASES
+]
+
+@lru_cache(maxsize=None)
+def normalize_command(command):
+    if not isinstance(command, str):
+        return 'nan'
+
+    command = command.upper()
+    for pattern, replacement in COMPILED_COMMAND_ALIASES:
+        command = pattern.sub(replacement, command)
+
+    if command in UNKNOWN_COMMANDS:
+        return 'nan'
+
+    command = command.strip()
+
+    # zero-padded precinct numbers ('075') become '75'
+    try:
+        return str(pd.to_numeric(command))
+    except (ValueError, TypeError):
+        return command
+
+def normalize_commands(commands):
+    # normalize each distinct command string once and map the results back
+    # onto the rows through the factorized codes
+    codes, uniques = pd.factorize(commands)
+
+    normalized = np.array(
+        [normalize_command(command) for command in uniques] + ['nan'],
+        dtype=object
+    )
+
+    # code -1 (missing) picks up the trailing 'nan'
+    return pd.Series(
+        normalized[codes],
+        index=commands.index,
+        name=commands.name
+    )
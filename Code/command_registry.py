@@ -0,0 +1,166 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+## command registry
+# one row per normalized command, in the order of the shared command
+# dictionary's categories, so a command's id is its categorical code: every
+# command_normalized column and index loaded with the dictionary already
+# holds the ids, and looking an attribute up is indexing an array by them
+# rather than matching strings.
+#
+# attributes:
+#   - is_geographic: one of the 77 precincts with a patrol area,
+#   - patrol_borough and borough: where the command patrols, for the
+#     precincts and for the borough-level units whose names say so (e.g.
+#     'PBBN TF', 'NARC BORO BRONX'); missing for citywide units,
+#   - command_type: precinct, patrol borough, transit, housing, ... from the
+#     command's name, 'other' where no pattern matches.
+
+PATROL_BOROUGH_PRECINCTS = {
+    'PBMS': ['1', '5', '6', '7', '9', '10', '13', '14', '17', '18'],
+    'PBMN': ['19', '20', '22', '23', '24', '25', '26', '28', '30', '32', '33', '34'],
+    'PBBX': ['40', '41', '42', '43', '44', '45', '46', '47', '48', '49', '50', '52'],
+    'PBBS': ['60', '61', '62', '63', '66', '67', '68', '69', '70', '71', '72', '76', '78'],
+    'PBBN': ['73', '75', '77', '79', '81', '83', '84', '88', '90', '94'],
+    'PBQS': ['100', '101', '102', '103', '105', '106', '107', '113'],
+    'PBQN': ['104', '108', '109', '110', '111', '112', '114', '115'],
+    'PBSI': ['120', '121', '122', '123']
+}
+
+PATROL_BOROUGH_BOROUGHS = {
+    'PBMS': 'Manhattan',
+    'PBMN': 'Manhattan',
+    'PBBX': 'Bronx',
+    'PBBS': 'Brooklyn',
+    'PBBN': 'Brooklyn',
+    'PBQS': 'Queens',
+    'PBQN': 'Queens',
+    'PBSI': 'Staten Island'
+}
+
+PRECINCTS = sorted(
+    (precinct for precincts in PATROL_BOROUGH_PRECINCTS.values() for precinct in precincts),
+    key=int
+)
+
+# borough-level units outside the precincts, by the patrol borough their
+# names carry
+PATROL_BOROUGH_UNIT_PATTERNS = {
+    'PBMS': r'^PBMS|^NARCBMS|^(PATROL|NARC) BORO MAN(HATTAN)? SOUTH',
+    'PBMN': r'^PBMN|^NARCBMN|^(PATROL|NARC) BORO MAN(HATTAN)? NORTH',
+    'PBBX': r'^PBBX|^NARC?BBX|^(PATROL|NARC) BORO BRONX',
+    'PBBS': r'^PBBS|^NARCBBS|^(PATROL|NARC) BORO (BKLYN|BROOKLYN) SOUTH',
+    'PBBN': r'^PBBN|^NARCBBN|^(PATROL|NARC) BORO (BKLYN|BROOKLYN) NORTH',
+    'PBQS': r'^PBQ/?S|^NARCBQS|^(PATROL|NARC) BORO QUEENS SOUTH',
+    'PBQN': r'^PBQ/?N|^NARCBQN|^(PATROL|NARC) BORO QUEENS NORTH',
+    'PBSI': r'^PBSI|^NARCBSI|^(PATROL|NARC) BORO STATEN ISLAND'
+}
+
+# (command type, pattern), the first match wins
+COMMAND_TYPE_PATTERNS = [
+    ('patrol borough', r'^PB|^PATROL BORO'),
+    ('transit', r'^TB\b|^TBD|^TB-|^TD |^TRANSIT|^ATU|TRANSIT BUREAU'),
+    ('housing', r'^HOUSING|^PSA|^PUBLIC SERVICE AREA|^HB|^H MAN'),
+    ('narcotics', r'^NARC|^NARB|^NAR |^ND |NARCOTICS'),
+    ('gang', r'^GANG'),
+    ('detective', r'^DB|^DET BORO'),
+    ('emergency service', r'^E S U$|^ESU|^EMER|^EMERGENCY SERVICES|^SI EMER'),
+    ('highway', r'^HWY|HIGHWAY'),
+    ('strategic response', r'SRG|^STRATEGIC RESP'),
+    ('vice', r'^VED?\b|^VICE')
+]
+
+COMPILED_PATROL_BOROUGH_UNIT_PATTERNS = {
+    patrol_borough: re.compile(pattern)
+    for patrol_borough, pattern in PATROL_BOROUGH_UNIT_PATTERNS.items()
+}
+
+COMPILED_COMMAND_TYPE_PATTERNS = [
+    (command_type, re.compile(pattern))
+    for command_type, pattern in COMMAND_TYPE_PATTERNS
+]
+
+PRECINCT_PATROL_BOROUGHS = {
+    precinct: patrol_borough
+    for patrol_borough, precincts in PATROL_BOROUGH_PRECINCTS.items()
+    for precinct in precincts
+}
+
+def patrol_borough_of(command):
+    if command in PRECINCT_PATROL_BOROUGHS:
+        return PRECINCT_PATROL_BOROUGHS[command]
+
+    for patrol_borough, pattern in COMPILED_PATROL_BOROUGH_UNIT_PATTERNS.items():
+        if pattern.search(command):
+            return patrol_borough
+
+    return None
+
+def command_type_of(command):
+    if command in PRECINCT_PATROL_BOROUGHS:
+        return 'precinct'
+    if command == 'nan':
+        return 'unknown'
+
+    for command_type, pattern in COMPILED_COMMAND_TYPE_PATTERNS:
+        if pattern.search(command):
+            return command_type
+
+    return 'other'
+
+def build_command_registry(command_dictionary):
+    commands = command_dictionary.categories
+    patrol_boroughs = pd.Series(
+        [patrol_borough_of(command) for command in commands],
+        dtype=pd.CategoricalDtype(list(PATROL_BOROUGH_BOROUGHS))
+    )
+
+    return pd.DataFrame(
+        {
+            'command_id': np.arange(len(commands), dtype='int32'),
+            'is_geographic': commands.isin(PRECINCTS),
+            'patrol_borough': patrol_boroughs.array,
+            'borough': (
+                patrol_boroughs
+                .map(PATROL_BOROUGH_BOROUGHS)
+                .astype(pd.CategoricalDtype(sorted(set(PATROL_BOROUGH_BOROUGHS.values()))))
+                .array
+            ),
+            'command_type': pd.Categorical([command_type_of(command) for command in commands])
+        },
+        index=pd.CategoricalIndex(commands, dtype=command_dictionary, name='command_normalized')
+    )
+
+## lookups by id
+
+def command_ids(commands):
+    # ids of a command_normalized index (or a MultiIndex with that level) or
+    # column; -1 where the command is missing
+    if isinstance(commands, pd.MultiIndex):
+        commands = commands.get_level_values('command_normalized')
+    if isinstance(commands, pd.Series):
+        return commands.cat.codes.to_numpy()
+    return commands.codes
+
+def mask_by_id(selected_by_id, commands):
+    # selected_by_id: one bool per command id; missing commands are never
+    # selected
+    ids = command_ids(commands)
+    return np.where(ids >= 0, selected_by_id[np.maximum(ids, 0)], False)
+
+def geographic_mask(command_registry, commands):
+    return mask_by_id(command_registry['is_geographic'].to_numpy(), commands)
+
+def attribute_mask(command_registry, commands, attribute, values):
+    # e.g. attribute_mask(registry, index, 'borough', ['Bronx'])
+    return mask_by_id(command_registry[attribute].isin(values).to_numpy(), commands)
+
+def values_by_id(values_by_command):
+    # a series indexed by command as one float per command id, NaN for the
+    # commands it doesn't cover
+    by_id = np.full(len(values_by_command.index.categories), np.nan)
+    ids = command_ids(values_by_command.index)
+    by_id[ids[ids >= 0]] = values_by_command.to_numpy()[ids >= 0]
+    return by_id
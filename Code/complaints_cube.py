@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+FADO_TYPES = (
+        'Abuse of Authority',
+        'Discourtesy',
+        'Offensive Language',
+        'Force',
+        'Untruthful Statement'
+    )
+
+## distinct-complaint cube
+# each complaint within an (incident_year, command_normalized) cell gets a
+# membership bitmap with one bit per (FADO Type, substantiated) pair:
+#   bit 2*i     -> has an unsubstantiated allegation of FADO_TYPES[i]
+#   bit 2*i + 1 -> has a substantiated allegation of FADO_TYPES[i]
+# complaints sharing a bitmap are collapsed to a count, so the cube is
+# (year x command x distinct bitmaps) rows. A complaint is counted for a
+# selection when its bitmap intersects the selection's bitmap, which keeps
+# multi-type counts exactly equal to a nunique over the allegation rows.
+#
+# the cells are further split by incident month, so counts by quarter or
+# month are sums over the cube like counts by year are. The incident date is
+# the complaint's (every allegation of a complaint carries it), so each
+# complaint is in one month of its year and summing the months gives the
+# year's distinct complaints back exactly.
+
+CUBE_KEYS = [
+    'incident_year',
+    'incident_month',
+    'command_normalized',
+    'membership'
+]
+
+# months per bucket of each time granularity
+GRANULARITIES = {
+    'Year': 12,
+    'Quarter': 3,
+    'Month': 1
+}
+
+def complaint_memberships(ccrb_allegations):
+    # one row per (complaint, command, membership bit): the allegations
+    # deduplicated down to what the cubes count. Kept alongside the cube, so
+    # cubes keyed by other groupings of the commands (see rollups.py) are
+    # built the same way without going back to the allegations
+    fado_codes = pd.Categorical(
+        ccrb_allegations['FADO Type'],
+        categories=FADO_TYPES
+    ).codes
+
+    return (
+        ccrb_allegations
+        [['incident_year','incident_month','command_normalized','Complaint Id']]
+        .assign(
+            membership = np.left_shift(
+                1,
+                2 * fado_codes.astype(np.int16)
+                + ccrb_allegations['CCRB disposition substantiated'].fillna(False).astype(np.int16)
+            ).astype(np.int16)
+        )
+        [fado_codes >= 0]
+        .dropna(subset=['incident_year','command_normalized'])
+        .astype({'incident_year':np.int16, 'incident_month':np.int8})
+        .drop_duplicates(subset=['incident_year','command_normalized','Complaint Id','membership'])
+        .reset_index(drop=True)
+    )
+
+def cube_from_memberships(memberships):
+    return (
+        memberships
+        # a no-op on complaint_memberships' rows, but not once their
+        # commands are relabeled with their groups
+        .drop_duplicates(subset=['incident_year','command_normalized','Complaint Id','membership'])
+        # bits are distinct after deduplication, so summing them is a bitwise or
+        .groupby(['incident_year','command_normalized','Complaint Id'], observed=True)
+        .agg(
+            membership = pd.NamedAgg('membership', 'sum'),
+            incident_month = pd.NamedAgg('incident_month', 'min')
+        )
+        .reset_index()
+        .astype({'incident_year':int, 'incident_month':int, 'membership':int})
+        .groupby(CUBE_KEYS, observed=True)
+        .size()
+        .rename('count_complaints')
+    )
+
+def selection_bitmap(fado_types, substantiated_only):
+    bitmap = 0
+    for fado_type in fado_types:
+        i = FADO_TYPES.index(fado_type)
+        bitmap |= 1 << (2 * i + 1)
+        if not substantiated_only:
+            bitmap |= 1 << (2 * i)
+    return bitmap
+
+def count_by_year_by_command(complaints_cube, fado_types, substantiated_only):
+    hits = (
+        complaints_cube.index.get_level_values('membership').to_numpy()
+        & selection_bitmap(fado_types, substantiated_only)
+    ) != 0
+
+    return (
+        complaints_cube
+        [hits]
+        .groupby(['incident_year','command_normalized'], observed=True)
+        .sum()
+        .rename('count_complaints')
+    )
+
+## time buckets
+# periods are numbered consecutively at every granularity, so a window of
+# periods is a range of integers like a window of years: a year is its own
+# number, a quarter is year * 4 + its index in the year, a month year * 12 +
+# its index
+
+def periods_per_year(granularity):
+    return 12 // GRANULARITIES[granularity]
+
+def period_of(incident_years, incident_months, granularity):
+    return (
+        incident_years * periods_per_year(granularity)
+        + (incident_months - 1) // GRANULARITIES[granularity]
+    )
+
+def period_start(periods, granularity):
+    # the first day of each period
+    years, index_in_year = np.divmod(np.asarray(periods), periods_per_year(granularity))
+    return pd.to_datetime(pd.DataFrame({
+        'year': years,
+        'month': index_in_year * GRANULARITIES[granularity] + 1,
+        'day': 1
+    }))
+
+def period_label(period, granularity):
+    year, index_in_year = divmod(int(period), periods_per_year(granularity))
+    if granularity == 'Quarter':
+        return f'{year} Q{index_in_year + 1}'
+    if granularity == 'Month':
+        return f'{year}-{index_in_year + 1:02d}'
+    return str(year)
+
+def count_by_period_by_command(complaints_cube, fado_types, substantiated_only, granularity):
+    hits = (
+        complaints_cube.index.get_level_values('membership').to_numpy()
+        & selection_bitmap(fado_types, substantiated_only)
+    ) != 0
+    selected = complaints_cube[hits]
+
+    periods = period_of(
+        selected.index.get_level_values('incident_year').to_numpy(),
+        selected.index.get_level_values('incident_month').to_numpy(),
+        granularity
+    )
+
+    return (
+        selected
+        .groupby(
+            [
+                pd.Index(periods, name='incident_period'),
+                selected.index.get_level_values('command_normalized')
+            ],
+            observed=True
+        )
+        .sum()
+        .rename('count_complaints')
+    )
@@ -0,0 +1,104 @@
+import io
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import xlsxwriter
+except ImportError:
+    # the Excel workbook is only offered where xlsxwriter is installed
+    xlsxwriter = None
+
+EXCEL_AVAILABLE = xlsxwriter is not None
+
+## download files
+# every format is written a chunk of rows at a time into one growing output
+# buffer, so a large table (the annual detail grows with years x commands)
+# is never held as a second, fully formatted copy besides the output:
+#   - CSV is formatted and encoded chunk by chunk rather than into one str,
+#   - Parquet gets one row group per chunk,
+#   - the Excel workbook is written with xlsxwriter's constant_memory mode,
+#     which flushes each row once it is complete (pandas' to_excel writes
+#     cells column by column, which that mode can't take).
+#
+# the CSVs head each table with a params column; Parquet files carry the
+# params in their schema metadata and the workbook in a parameters sheet.
+
+EXPORT_CHUNK_ROWS = 10_000
+
+CSV_MIME = 'text/csv'
+EXCEL_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+PARQUET_MIME = 'application/vnd.apache.parquet'
+
+# Excel number formats of the columns that have one
+EXCEL_COLUMN_FORMATS = {
+    'Pct change': '0%',
+    'Settlement grand total': '$#,##0.00',
+    'Median settlement': '$#,##0.00',
+    '90th percentile settlement': '$#,##0.00',
+    '99th percentile settlement': '$#,##0.00'
+}
+
+def chunks(table, chunk_rows):
+    for start in range(0, len(table), chunk_rows):
+        yield start, table.iloc[start:start + chunk_rows]
+
+def write_csv(table, chunk_rows=EXPORT_CHUNK_ROWS):
+    buffer = io.BytesIO()
+    table.to_csv(buffer, index=False, chunksize=chunk_rows, encoding='utf-8')
+    return buffer.getvalue()
+
+def write_parquet(table, params, chunk_rows=EXPORT_CHUNK_ROWS):
+    # year columns (the annual detail's) become strings, as Parquet
+    # column names must be
+    table = table.rename(columns=str)
+
+    schema = pa.Schema.from_pandas(table, preserve_index=False)
+    schema = schema.with_metadata({
+        **schema.metadata,
+        b'params': json.dumps([param for param in params if param]).encode()
+    })
+
+    sink = pa.BufferOutputStream()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for _, chunk in chunks(table, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+    return sink.getvalue().to_pybytes()
+
+def excel_value(value):
+    # blank cells for missing values, which xlsxwriter won't write as numbers
+    return None if pd.isna(value) else value
+
+def write_excel(sheets, params, chunk_rows=EXPORT_CHUNK_ROWS):
+    # sheets: sheet name -> table, written after a parameters sheet
+    buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {'constant_memory': True})
+    header_format = workbook.add_format({'bold': True})
+    column_formats = {
+        column: workbook.add_format({'num_format': num_format})
+        for column, num_format in EXCEL_COLUMN_FORMATS.items()
+    }
+
+    parameters_sheet = workbook.add_worksheet('parameters')
+    parameters_sheet.set_column(0, 0, 100)
+    for row, param in enumerate(param for param in params if param):
+        parameters_sheet.write_string(row, 0, param)
+
+    for sheet_name, table in sheets.items():
+        sheet = workbook.add_worksheet(sheet_name)
+
+        for column_number, column in enumerate(table.columns):
+            if column in column_formats:
+                sheet.set_column(column_number, column_number, 16, column_formats[column])
+
+        sheet.write_row(0, 0, [str(column) for column in table.columns], header_format)
+
+        for start, chunk in chunks(table, chunk_rows):
+            for offset, values in enumerate(chunk.itertuples(index=False, name=None)):
+                sheet.write_row(start + offset + 1, 0, [excel_value(value) for value in values])
+
+    workbook.close()
+    return buffer.getvalue()
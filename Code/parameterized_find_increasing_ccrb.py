@@ -3,10 +3,23 @@ import pandas as pd
 # import geopandas as gpd
 import altair as alt
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import numpy as np
 
-# from io import BytesIO
-# import xlsxwriter
+import json
+import os
+from functools import partial, wraps
+
+from chart_specs import chart_to_json, concat_specs
+from cases_cube import build_cases_cube, count_selected_cases as count_cases_in_cube
+import ccrb_engine
+from ccrb_engine import COMPLAINT_YEARS, NORMALIZERS, ROLLING_COMPARISONS, ROLLING_GRANULARITIES
+import change_engine
+from command_registry import build_command_registry
+from complaints_cube import FADO_TYPES, complaint_memberships, count_by_year_by_command as count_from_cube, cube_from_memberships, period_start, periods_per_year
+from exports import CSV_MIME, EXCEL_AVAILABLE, EXCEL_MIME, PARQUET_MIME, write_csv, write_excel, write_parquet
+from rollups import COMMAND_LEVEL, LEVELS, roll_up_complaints, spread_to_precincts
+from stage_instrumentation import StageRecorder, enable_logging, instrumented, stage
 
 # import requests
 
@@ -14,110 +27,103 @@ st.set_page_config(
     layout='wide'
 )
 
-FADO_TYPES = (
-        'Abuse of Authority', 
-        'Discourtesy', 
-        'Offensive Language', 
-        'Force',
-        'Untruthful Statement'
-    )
-
-PRECINCTS = ['1', '5', '6', '7', '9', '10', '13', '14', '17', '18', '19', '20', '22',
-       '23', '24', '25', '26', '28', '30', '32', '33', '34', '40', '41', '42',
-       '43', '44', '45', '46', '47', '48', '49', '50', '52', '60', '61', '62',
-       '63', '66', '67', '68', '69', '70', '71', '72', '73', '75', '76', '77',
-       '78', '79', '81', '83', '84', '88', '90', '94', '100', '101', '102',
-       '103', '104', '105', '106', '107', '108', '109', '110', '111', '112',
-       '113', '114', '115', '120', '121', '122', '123']
-
-@st.cache_data(show_spinner='Loading CCRB records...')
+if int(pd.__version__.split('.')[0]) < 3:
+    # always on from pandas 3.0
+    pd.set_option('mode.copy_on_write', True)
+
+## stage instrumentation
+# opt-in: ?debug=1 records every stage of this session's reruns and shows
+# them in an expander at the bottom; CCRB_STAGE_LOG=1 logs them (time and
+# rows) as JSON lines for every session, CCRB_STAGE_LOG=memory with the
+# allocated bytes too. Off by default, as tracing allocations slows every
+# stage down.
+
+show_stage_timings = st.query_params.get('debug') == '1'
+log_stage_timings = os.environ.get('CCRB_STAGE_LOG', '') in ('1', 'memory')
+
+stage_recorder = None
+if show_stage_timings or log_stage_timings:
+    # a rerun that stopped early (e.g. interrupted by a widget change) never
+    # finished its recorder
+    if 'stage_recorder' in st.session_state:
+        st.session_state['stage_recorder'].finish()
+
+    stage_recorder = StageRecorder(
+        session_id=get_script_run_ctx().session_id if get_script_run_ctx() else None,
+        track_memory=show_stage_timings or os.environ['CCRB_STAGE_LOG'] == 'memory'
+    ).start()
+    st.session_state['stage_recorder'] = stage_recorder
+
+    if log_stage_timings:
+        enable_logging()
+
+def shared_dataset(show_spinner):
+    # load once per process with st.cache_resource (no per-rerun pickle copy
+    # like st.cache_data) and hand each caller a shallow copy. Under
+    # copy-on-write the shallow copy shares every column with the cached
+    # object, and any write a session makes copies only the column it touches,
+    # so the process-wide dataset is never mutated and never duplicated.
+    def decorator(loader):
+        load_shared = st.cache_resource(show_spinner=show_spinner)(loader)
+
+        @wraps(loader)
+        def load():
+            return load_shared().copy(deep=False)
+
+        return load
+
+    return decorator
+
+# written by Code/build_precinct_topojson.py next to the app's static files
+PRECINCTS_MANIFEST_PATH = os.path.join(os.path.dirname(__file__), 'static', 'precincts_topojson.json')
+
+# width of each map in the viz (px), which picks the boundaries' simplification level
+MAP_WIDTH = 300
+
+# commands with the largest changes drawn in the trend and rank charts
+TOP_COMMANDS = 10
+
+@instrumented()
+@st.cache_resource(show_spinner='Loading commands...')
+def load_command_dictionary():
+    return ccrb_engine.load_command_dictionary()
+
+@instrumented()
+@st.cache_resource(show_spinner=False)
+def load_command_registry():
+    return build_command_registry(load_command_dictionary())
+
+# not cached: only the complaint memberships and the complaints cube built
+# from the allegations are kept, so they're freed once those are built
+@instrumented()
 def load_ccrb():
+    return ccrb_engine.load_ccrb(load_command_dictionary())
+
+@instrumented()
+@shared_dataset(show_spinner='Summarizing CCRB complaints...')
+def load_complaint_memberships():
+    return complaint_memberships(load_ccrb())
+
+@instrumented()
+@shared_dataset(show_spinner='Summarizing CCRB complaints...')
+def load_complaints_cube():
+    return cube_from_memberships(load_complaint_memberships())
+
+@instrumented()
+@st.cache_data
+def count_complaints(fado_types_selected, substantiated_only_selected):
+    return count_from_cube(
+        load_complaints_cube(),
+        fado_types_selected,
+        substantiated_only_selected
+    )
 
-    # ccrb_allegations = pd.read_csv(
-    #     'https://data.cityofnewyork.us/api/views/6xgr-kwjq/rows.csv?accessType=DOWNLOAD',
-    #     dtype={'Tax ID':str},
-    #     parse_dates=['As Of Date']
-    #     )
-
-    # ccrb_complaints = pd.read_csv(
-    #     'https://data.cityofnewyork.us/api/views/2mby-ccnw/rows.csv?accessType=DOWNLOAD',
-    #     dtype={'Tax ID':str},
-    #     parse_dates=['Incident Date', 'CCRB Received Date','Close Date']
-    # )
-
-    # ccrb_complaints['Incident Date'] = pd.to_datetime(ccrb_complaints['Incident Date'], errors='coerce')
-    
-    # ccrb_allegations = ccrb_allegations.merge(
-    #     ccrb_complaints.drop(columns='As Of Date'), 
-    #     on='Complaint Id'
-    # )
-
-    # ccrb_allegations = (
-    #     ccrb_allegations
-    #     .assign(
-    #         command_normalized = (
-    #             ccrb_allegations['Officer Command At Incident']
-    #             .str.upper()
-    #             .str.replace('(?<=\d) *TH','',regex=True)
-    #             .str.replace('(?<=\d) *ND','',regex=True)
-    #             .str.replace('(?<=\d) *RD','',regex=True)
-    #             .str.replace('PCT[\. ]*','',regex=True)
-    #             .str.replace('CMD','')
-    #             .str.replace('PRECINCT','')
-    #             .str.replace('PRE','')
-    #             .str.replace('DET(ECTIVE)*','',regex=True)
-    #             .str.replace('COMMAND','')
-    #             .str.replace('SQUAD','')
-    #             .str.replace('MTS','14')
-    #             .str.replace('MIDTOWN SOUTH','14')
-    #             .str.replace('MTN','18')
-    #             .str.replace('MIDTOWN NORTH','18')
-    #             .str.replace('CPK','22')
-    #             .str.replace('POLICE SERVICE AREA','PSA')
-    #             .str.replace('E.S.U.','E S U', regex=False)
-    #             .str.replace('NARC BBX','NARCBBX')
-    #             .str.replace('NARCOTICS BOROUGH BRONX','NARCBBX')
-    #             .str.replace('NARCBBN DIVISION','NARCBBN')
-    #             .str.replace('BROOKLYN NORTH NARCOTICS','NARCBBN')
-    #             .str.replace('NARCOTICS BOROUGH BROOKLYN NORTH','NARCBBN')
-    #             .str.replace('BNNARC','NARCBBN')
-    #             .str.replace('NARCBNN','NARCBBN')
-    #             .str.replace('BROOKLYN SOUTH NARCOTICS','NARCBBS')
-    #             .str.replace('NARC BBS','NARCBBS')
-    #             .str.replace('NARCOTICS BOROUGH BROOKLYN SOUTH','NARCBBS')
-    #             .str.replace('NARCOTICS BORO BROOKLYN SOUTH','NARCBBS')
-    #             .str.replace('BROOKLYN SOUTH NARCOTICS DISTRICT','NARCBBS')
-    #             .str.replace('NARCOTICS BORO STATEN ISLAND','NARCBSI')
-    #             .str.replace('NARCOTICS BOROUGH STATEN ISLAND','NARCBSI')
-    #             .str.replace('QS NARC','NARCBQS')
-    #             .str.replace('MANHATTAN SOUTH NARCOTICS DISTRICT','NARCBMS')
-    #             .str.replace('NARCOTICS BORO MANHATTAN NORTH','NARCBMN')
-    #             .str.replace('WARRANT SECTION','WARRSEC')
-    #             .str.replace('QS GANG','GANG QS')
-    #             .str.replace('MANHATTAN GANG','GANG M')
-    #             .str.replace('GANG MANHATTAN','GANG M')
-    #             .str.replace('QUEENS GANG','GANG Q')
-    #             .str.replace('STATEN ISLAND GANGS DIVISION','GANG SI')
-    #             .str.replace('GANG  BROOKLYN SOUTH', 'GANG BS')
-    #             .str.replace('BROOKLYN SOUTH GANG','GANG BS')
-    #             .str.replace('BROOKLYN SOUTH GANG UNIT','GANG BS')
-    #             .str.replace('BN GANG UNIT','GANG BN')
-    #             .mask(lambda a: a == 'UNIDENTIFIED')
-    #             .mask(lambda a: a == 'UNKNOWN')
-    #             .str.strip()
-    #             # .str.replace(' ','')
-    #             .apply(pd.to_numeric, errors = 'ignore')
-    #             .astype(str)
-    #         )
-    #     )
-    # )
-
-    # ccrb_allegations['CCRB disposition substantiated'] = ccrb_allegations['CCRB Allegation Disposition'].str.contains('Substantiated')
-
-    ccrb_allegations = pd.read_parquet('Data/Processed Data/ccrb_allegations_with_labels.parquet')
-
-    return ccrb_allegations
+@st.cache_data
+def load_precincts_manifest():
+    with open(PRECINCTS_MANIFEST_PATH) as f:
+        return json.load(f)
 
+@instrumented()
 @st.cache_data(show_spinner='Loading precincts map...')
 def load_precincts():
 
@@ -148,10 +154,25 @@ def load_precincts():
     #     )
     # )
 
+    # return (
+    #     alt.Data(
+    #         url='app/static/precincts_census_4326.geojson',
+    #         format=alt.DataFormat(property='features')
+    #     )
+    # )
+
+    # the most simplified TopoJSON level that still holds up at the maps' width
+    manifest = load_precincts_manifest()
+    level = next(
+        level
+        for level in manifest['levels']
+        if level['max_width'] is None or level['max_width'] >= MAP_WIDTH
+    )
+
     return (
         alt.Data(
-            url='app/static/precincts_census_4326.geojson',
-            format=alt.DataFormat(property='features')
+            url=f"app/static/{level['file']}",
+            format=alt.DataFormat(type='topojson', feature=manifest['object'])
         )
     )
 
@@ -165,111 +186,22 @@ def load_precincts():
 
 #     return precincts
     
-@st.cache_data(show_spinner='Loading officers roster...')
+@instrumented()
+@shared_dataset(show_spinner='Loading officers roster...')
 def load_officers_by_command():
-    # roster = pd.read_csv(
-    #     'https://data.cityofnewyork.us/api/views/2fir-qns4/rows.csv?date=20231205&accessType=DOWNLOAD',
-    #     parse_dates=['Last Reported Active Date'],
-    #     true_values=['Yes'],
-    #     false_values=['No'],
-    #     dtype={'Tax ID':str}
-    # )
+    return ccrb_engine.load_officers_by_command(load_command_dictionary())
 
-    # roster = (
-    #     roster
-    #     .assign(
-    #         command_normalized = (
-    #             ccrb_allegations['Officer Command At Incident']
-    #             .str.upper()
-    #             .str.replace('(?<=\d) *TH','',regex=True)
-    #             .str.replace('(?<=\d) *ND','',regex=True)
-    #             .str.replace('(?<=\d) *RD','',regex=True)
-    #             .str.replace('PCT[\. ]*','',regex=True)
-    #             .str.replace('CMD','')
-    #             .str.replace('PRECINCT','')
-    #             .str.replace('PRE','')
-    #             .str.replace('DET(ECTIVE)*','',regex=True)
-    #             .str.replace('COMMAND','')
-    #             .str.replace('SQUAD','')
-    #             .str.replace('MTS','14')
-    #             .str.replace('MIDTOWN SOUTH','14')
-    #             .str.replace('MTN','18')
-    #             .str.replace('MIDTOWN NORTH','18')
-    #             .str.replace('CPK','22')
-    #             .str.replace('POLICE SERVICE AREA','PSA')
-    #             .str.replace('E.S.U.','E S U', regex=False)
-    #             .str.replace('NARC BBX','NARCBBX')
-    #             .str.replace('NARCOTICS BOROUGH BRONX','NARCBBX')
-    #             .str.replace('NARCBBN DIVISION','NARCBBN')
-    #             .str.replace('BROOKLYN NORTH NARCOTICS','NARCBBN')
-    #             .str.replace('NARCOTICS BOROUGH BROOKLYN NORTH','NARCBBN')
-    #             .str.replace('BNNARC','NARCBBN')
-    #             .str.replace('NARCBNN','NARCBBN')
-    #             .str.replace('BROOKLYN SOUTH NARCOTICS','NARCBBS')
-    #             .str.replace('NARC BBS','NARCBBS')
-    #             .str.replace('NARCOTICS BOROUGH BROOKLYN SOUTH','NARCBBS')
-    #             .str.replace('NARCOTICS BORO BROOKLYN SOUTH','NARCBBS')
-    #             .str.replace('BROOKLYN SOUTH NARCOTICS DISTRICT','NARCBBS')
-    #             .str.replace('NARCOTICS BORO STATEN ISLAND','NARCBSI')
-    #             .str.replace('NARCOTICS BOROUGH STATEN ISLAND','NARCBSI')
-    #             .str.replace('QS NARC','NARCBQS')
-    #             .str.replace('MANHATTAN SOUTH NARCOTICS DISTRICT','NARCBMS')
-    #             .str.replace('NARCOTICS BORO MANHATTAN NORTH','NARCBMN')
-    #             .str.replace('WARRANT SECTION','WARRSEC')
-    #             .str.replace('QS GANG','GANG QS')
-    #             .str.replace('MANHATTAN GANG','GANG M')
-    #             .str.replace('GANG MANHATTAN','GANG M')
-    #             .str.replace('QUEENS GANG','GANG Q')
-    #             .str.replace('STATEN ISLAND GANGS DIVISION','GANG SI')
-    #             .str.replace('GANG  BROOKLYN SOUTH', 'GANG BS')
-    #             .str.replace('BROOKLYN SOUTH GANG','GANG BS')
-    #             .str.replace('BROOKLYN SOUTH GANG UNIT','GANG BS')
-    #             .str.replace('BN GANG UNIT','GANG BN')
-    #             .mask(lambda a: a == 'UNIDENTIFIED')
-    #             .mask(lambda a: a == 'UNKNOWN')
-    #             .str.strip()
-    #             # .str.replace(' ','')
-    #             .apply(pd.to_numeric, errors = 'ignore')
-    #             .astype(str)
-    #         )
-    #     )
-    # )
-        
-    # active_officers_by_command = (
-    #     roster
-    #     [
-    #         roster['Active Per Last Reported Status']
-    #     ]
-    #     .groupby('command_normalized')
-    #     ['Tax ID']
-    #     .nunique()
-    # )
-
-    active_officers_by_command = (
-        pd.read_parquet('Data/Processed Data/active_officers_by_command.parquet')
-        ['count_officers']
-    )
-
-    return active_officers_by_command
-
-@st.cache_data(show_spinner='Loading crime rates...')
+@instrumented()
+@shared_dataset(show_spinner='Loading crime rates...')
 def load_index_crimes():
-    return (
-        pd.read_csv(
-            'Data/Processed Data/index_crimes_by_precinct_2024.csv',
-            dtype={'precinct':str}
-        )
-        .rename(columns={'precinct':'command_normalized'})
-        .set_index('command_normalized')
-        ['index_crimes_2024']
-    )
+    return ccrb_engine.load_index_crimes(load_command_dictionary())
 
-@st.cache_data(show_spinner='Loading cases...')
+@instrumented()
+@shared_dataset(show_spinner='Loading cases...')
 def load_cases():
-    return pd.read_parquet('Data/Processed Data/cases_dates_locations.parquet')
+    return ccrb_engine.load_cases(load_command_dictionary())
 
 
-ccrb_allegations = load_ccrb()
 precincts = load_precincts()
 # active_officers_by_command = (
 #     load_officers_by_command()
@@ -281,9 +213,285 @@ precincts = load_precincts()
 #         .values
 #     )
 # )
-active_officers_by_command = load_officers_by_command()
-index_crimes = load_index_crimes()
-cases = load_cases()
+
+## pipeline stages
+# each stage is memoized on exactly the widget values it reads and calls the
+# stages it depends on, so a widget change only reruns the stages downstream
+# of it: toggling a cases option never recomputes a CCRB aggregation, and
+# moving the threshold slider reuses the period comparison
+
+@instrumented()
+def load_normalizer(normalize_by_selected):
+    return ccrb_engine.select_normalizer(
+        normalize_by_selected,
+        load_officers_by_command(),
+        load_index_crimes()
+    )
+
+# above the command level complaints are counted from the groups' own
+# complaints cube, built from the complaint memberships, and the cases are
+# rolled up from the cases cube's per-command totals, so switching levels
+# never rescans the allegations. The geographic toggle picks the commands rolled up there, so
+# the selection stages below take it only as rolls_up_geographic_only, which
+# is always False at the command level: toggling it there still only
+# refilters the change table.
+
+@instrumented()
+@st.cache_resource(show_spinner=False)
+def load_command_groups(aggregation_level_selected, rolls_up_geographic_only):
+    return ccrb_engine.select_groups(
+        load_command_registry(),
+        aggregation_level_selected,
+        rolls_up_geographic_only
+    )
+
+# normalized_for: the cube of the groups of only the commands that
+# normalizer covers, whose complaints it normalizes
+@instrumented()
+@st.cache_resource(show_spinner=False)
+def load_complaints_cube_at_level(aggregation_level_selected, rolls_up_geographic_only, normalized_for=None):
+    groups = load_command_groups(aggregation_level_selected, rolls_up_geographic_only)
+
+    if normalized_for is not None:
+        covered = ccrb_engine.normalizer_groups(groups, load_normalizer(normalized_for))
+        if covered is not groups:
+            return roll_up_complaints(load_complaint_memberships(), covered)
+
+    return ccrb_engine.complaints_cube_at_level(load_complaints_cube(), load_complaint_memberships(), groups)
+
+@instrumented()
+@st.cache_data
+def count_complaints_at_level(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only, normalized_for=None):
+    if aggregation_level_selected == COMMAND_LEVEL:
+        return count_complaints(fado_types_selected, substantiated_only_selected)
+
+    return count_from_cube(
+        load_complaints_cube_at_level(aggregation_level_selected, rolls_up_geographic_only, normalized_for),
+        fado_types_selected,
+        substantiated_only_selected
+    )
+
+@instrumented()
+@st.cache_data
+def normalize_complaints(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only):
+    return ccrb_engine.normalize_at_level(
+        count_complaints_at_level(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only, normalize_by_selected),
+        load_normalizer(normalize_by_selected),
+        load_command_groups(aggregation_level_selected, rolls_up_geographic_only)
+    )
+
+@instrumented()
+@st.cache_data
+def average_complaints_by_year(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only):
+    return ccrb_engine.average_complaints_by_year(
+        normalize_complaints(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only)
+    )
+
+# built once per complaint selection and normalizer and shared across reruns
+# and sessions (its arrays are read-only); every year window is then answered
+# from its prefix sums and sparse table without touching the complaint rows.
+# One is cached per combination of the complaint widgets, so only the most
+# recent ones are kept: an evicted matrix is rebuilt from the cached counts
+@instrumented()
+@st.cache_resource(show_spinner=False, max_entries=20)
+def complaints_matrix(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only):
+    return change_engine.to_year_command_matrix(
+        count_complaints_at_level(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only),
+        normalize_complaints(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only)
+    )
+
+@instrumented()
+@st.cache_data
+def compare_periods(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    reference_years,
+    focus_years,
+    geographic_precincts_only_selector,
+    aggregation_level_selected
+):
+    return ccrb_engine.compare_periods(
+        complaints_matrix(
+            fado_types_selected,
+            substantiated_only_selected,
+            normalize_by_selected,
+            aggregation_level_selected,
+            ccrb_engine.rolls_up_geographic_only(aggregation_level_selected, geographic_precincts_only_selector)
+        ),
+        reference_years,
+        focus_years,
+        geographic_precincts_only_selector,
+        aggregation_level_selected,
+        load_command_registry()
+    )
+
+@instrumented()
+@st.cache_data
+def filter_to_threshold(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    reference_years,
+    focus_years,
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
+):
+    return ccrb_engine.filter_to_threshold(
+        compare_periods(
+            fado_types_selected,
+            substantiated_only_selected,
+            normalize_by_selected,
+            reference_years,
+            focus_years,
+            geographic_precincts_only_selector,
+            aggregation_level_selected
+        ),
+        complaints_matrix(
+            fado_types_selected,
+            substantiated_only_selected,
+            normalize_by_selected,
+            aggregation_level_selected,
+            ccrb_engine.rolls_up_geographic_only(aggregation_level_selected, geographic_precincts_only_selector)
+        ),
+        reference_years,
+        focus_years,
+        minimum_instances_threshold
+    )
+
+@instrumented()
+@st.cache_data
+def rank_commands(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    reference_years,
+    focus_years,
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
+):
+    # ranked among every command passing the filters, but only over the
+    # years the rank chart spans and for the commands it draws
+    change_by_precinct_filtered_to_more_than_threshold_instances = filter_to_threshold(
+        fado_types_selected,
+        substantiated_only_selected,
+        normalize_by_selected,
+        reference_years,
+        focus_years,
+        geographic_precincts_only_selector,
+        minimum_instances_threshold,
+        aggregation_level_selected
+    )
+
+    return ccrb_engine.rank_commands(
+        complaints_matrix(
+            fado_types_selected,
+            substantiated_only_selected,
+            normalize_by_selected,
+            aggregation_level_selected,
+            ccrb_engine.rolls_up_geographic_only(aggregation_level_selected, geographic_precincts_only_selector)
+        ),
+        change_by_precinct_filtered_to_more_than_threshold_instances.index,
+        (reference_years[0], focus_years[1]),
+        ccrb_engine.top_changes(change_by_precinct_filtered_to_more_than_threshold_instances, TOP_COMMANDS).index
+    )
+
+# the recent changes section's stages: the same selection counted by quarter
+# or month from the complaints cube, and every trailing window of them
+# compared at once
+
+@instrumented()
+@st.cache_data
+def count_complaints_by_period(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only, granularity_selected, normalized_for=None):
+    return ccrb_engine.count_by_period(
+        load_complaints_cube_at_level(aggregation_level_selected, rolls_up_geographic_only, normalized_for),
+        fado_types_selected,
+        substantiated_only_selected,
+        granularity_selected
+    )
+
+# a monthly matrix is many times the yearly one, so fewer are kept; like the
+# yearly ones they're read-only and rebuilt from the cached counts once
+# evicted
+@instrumented()
+@st.cache_resource(show_spinner=False, max_entries=8)
+def period_matrix(fado_types_selected, substantiated_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only, granularity_selected):
+    return change_engine.to_year_command_matrix(
+        count_complaints_by_period(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only, granularity_selected),
+        ccrb_engine.normalize_at_level(
+            count_complaints_by_period(fado_types_selected, substantiated_only_selected, aggregation_level_selected, rolls_up_geographic_only, granularity_selected, normalize_by_selected),
+            load_normalizer(normalize_by_selected),
+            load_command_groups(aggregation_level_selected, rolls_up_geographic_only)
+        )
+    )
+
+@instrumented()
+@st.cache_data
+def rolling_changes(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    geographic_precincts_only_selector,
+    aggregation_level_selected,
+    granularity_selected,
+    window_periods,
+    comparison_selected,
+    rolling_threshold
+):
+    return ccrb_engine.rolling_changes(
+        period_matrix(
+            fado_types_selected,
+            substantiated_only_selected,
+            normalize_by_selected,
+            aggregation_level_selected,
+            ccrb_engine.rolls_up_geographic_only(aggregation_level_selected, geographic_precincts_only_selector),
+            granularity_selected
+        ),
+        window_periods,
+        comparison_selected,
+        granularity_selected,
+        rolling_threshold,
+        geographic_precincts_only_selector,
+        aggregation_level_selected,
+        load_command_registry()
+    )
+
+@instrumented()
+@st.cache_data
+def count_cases_by_year():
+    return (
+        load_cases()
+        .groupby(
+            pd.Grouper(freq='YE',key='Date of Occurrence')
+        )
+        .size()
+        .rename('count cases')
+        .loc['2005-12-31':]
+        .reset_index()
+    )
+
+@instrumented()
+@st.cache_resource(show_spinner='Summarizing cases...')
+def load_cases_cube():
+    return build_cases_cube(load_cases())
+
+@instrumented()
+@st.cache_data
+def count_selected_cases(case_years, with_settlement_only_selected):
+    return count_cases_in_cube(load_cases_cube(), case_years, with_settlement_only_selected)
+
+@instrumented()
+@st.cache_data
+def summarize_cases(case_years, with_settlement_only_selected, normalize_by_selected, aggregation_level_selected, rolls_up_geographic_only):
+    return ccrb_engine.summarize_cases(
+        load_cases_cube(),
+        case_years,
+        with_settlement_only_selected,
+        load_normalizer(normalize_by_selected),
+        load_command_groups(aggregation_level_selected, rolls_up_geographic_only)
+    )
 
 ## options sidebar
 
@@ -295,11 +503,15 @@ with st.expander(label='Set options',expanded=True):
 
     normalize_by_selected = st.radio(
         label='Normalize by:',
-        options=(
-            'None',
-            'Currently active officers',
-            '2024 Index crimes'
-        ),
+        options=NORMALIZERS,
+        horizontal=True
+    )
+
+    st.write("##### Aggregate")
+
+    aggregation_level_selected = st.radio(
+        label='Roll precincts/commands up to:',
+        options=LEVELS,
         horizontal=True
     )
 
@@ -318,15 +530,15 @@ with st.expander(label='Set options',expanded=True):
 
     reference_start_year, reference_end_year = st.slider(
         label='Reference years (i.e. baseline years, years to compare from) for complaints:',
-        min_value=2000,
-        max_value=2024,
+        min_value=COMPLAINT_YEARS[0],
+        max_value=COMPLAINT_YEARS[1],
         value=(2019,2021)
     )
 
     focus_start_year, focus_end_year = st.slider(
         label='Focus years (i.e. current years of interest) for complaints:',
-        min_value=2000,
-        max_value=2024,
+        min_value=COMPLAINT_YEARS[0],
+        max_value=COMPLAINT_YEARS[1],
         value=(2022,2024)
     )
 
@@ -376,160 +588,75 @@ with st.expander(label='Set options',expanded=True):
 
 ## filter and summarize data
 
-fado_type_filter = (
-    ccrb_allegations
-    ['FADO Type']
-    .isin(fado_types_selected)
-)
-
-substantiated_filter = (
-    ccrb_allegations['CCRB disposition substantiated'] 
-    if substantiated_only_selected 
-    else 
-    [True] * len(ccrb_allegations)
-)
-
-normalizer = (
-    active_officers_by_command if normalize_by_selected == 'Currently active officers' 
-    else index_crimes if normalize_by_selected == '2024 Index crimes'
-    else 1
-)
-
-count_by_year_by_command = (
-    ccrb_allegations
-    [
-        fado_type_filter
-        &
-        substantiated_filter
-    ]
-    .assign(
-        incident_year = lambda row: row['Incident Date'].dt.year
-    )
-    .groupby([
-        'incident_year',
-        'command_normalized'
-    ])
-    ['Complaint Id']
-    .nunique()
-    .rename('count_complaints')
-)
+normalizer = load_normalizer(normalize_by_selected)
 
-normalized_by_year_by_command = (
-    count_by_year_by_command
-    .div(normalizer)
-    .rename('count_complaints')
+rolled_up_geographic_only = ccrb_engine.rolls_up_geographic_only(
+    aggregation_level_selected,
+    geographic_precincts_only_selector
 )
 
-average_complaints = (
-    normalized_by_year_by_command
-    .unstack()
-    .mean(
-        axis=1, 
-        skipna=True
-    )
-    .rename('count_complaints')
+normalized_by_year_by_command = normalize_complaints(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    aggregation_level_selected,
+    rolled_up_geographic_only
 )
 
-median_complaints = (
-    normalized_by_year_by_command
-    .median(axis=0, skipna=True)
+average_complaints = average_complaints_by_year(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    aggregation_level_selected,
+    rolled_up_geographic_only
 )
 
-change_by_precinct = (
-    (
-        normalized_by_year_by_command
-        .loc[reference_start_year:reference_end_year]
-        .groupby('command_normalized')
-        .mean()
-        .rename('reference_years')
-        .to_frame()
-    ).join(
-        normalized_by_year_by_command
-        .loc[focus_start_year:focus_end_year]
-        .groupby('command_normalized')
-        .mean()
-        .rename('focus_years')
-    )
-    .fillna(0)
-    .assign(
-        pct_change = lambda row: row.pct_change(axis=1)['focus_years'],
-    )
-    .dropna(subset='pct_change')
-    .sort_values('pct_change',ascending=False)
-)
-
-if geographic_precincts_only_selector:
-    change_by_precinct = (
-        change_by_precinct
-        .loc[PRECINCTS]
-        .sort_values('pct_change',ascending=False)
-    )
-
-change_by_precinct_filtered_to_more_than_threshold_instances = (
-    change_by_precinct
-    [
-        (
-            count_by_year_by_command
-            .loc[reference_start_year:reference_end_year]
-            .groupby('command_normalized')
-            .max()
-            .ge(minimum_instances_threshold)
-        ) & (
-            count_by_year_by_command
-            .loc[focus_start_year:focus_end_year]
-            .groupby('command_normalized')
-            .max()
-            .ge(minimum_instances_threshold)
-        )
-    ]
+change_by_precinct_filtered_to_more_than_threshold_instances = filter_to_threshold(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    (reference_start_year, reference_end_year),
+    (focus_start_year, focus_end_year),
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
 )
 
 reference_years_column_label = f"{reference_start_year}-{reference_end_year} (annual mean)"
 focus_years_column_label = f"{focus_start_year}-{focus_end_year} (annual mean)"
 
-change_by_precinct_filtered__labeled = (
-    change_by_precinct_filtered_to_more_than_threshold_instances
-    [[
-        'pct_change',
-        'reference_years',
-        'focus_years'
-    ]]
-    .reset_index()
-    .rename(columns={
-        'command_normalized':'Precinct/command',
-        'reference_years':reference_years_column_label,
-        'focus_years':focus_years_column_label,
-        'pct_change':'Pct change'
-    })
-    .set_index('Precinct/command')
-)
-
-top_10_precincts = (
-    change_by_precinct_filtered_to_more_than_threshold_instances
-    .head(10)
-    .index
+change_by_precinct_filtered__labeled = ccrb_engine.label_change_by_precinct(
+    change_by_precinct_filtered_to_more_than_threshold_instances,
+    (reference_start_year, reference_end_year),
+    (focus_start_year, focus_end_year),
+    aggregation_level_selected
 )
 
-precincts_ranks = (
-    normalized_by_year_by_command
-    .loc[:,change_by_precinct_filtered_to_more_than_threshold_instances.index]
-    .unstack()
-    # .drop(columns='nan')
-    .rank(
-        axis=1,
-        method='min',
-        ascending=False
-    )
-    .stack()
-    .rename('rank')
+top_10_precincts = ccrb_engine.top_changes(
+    change_by_precinct_filtered_to_more_than_threshold_instances,
+    TOP_COMMANDS
+).index
+
+precincts_ranks = rank_commands(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    (reference_start_year, reference_end_year),
+    (focus_start_year, focus_end_year),
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
 )
 
-complaints_params = (
-    f"{'Substantiated' if substantiated_only_selected else 'All'} complaints of type(s): {', '.join(fado_types_selected)}",
-    f"{'per '+ normalize_by_selected.lower() if normalize_by_selected != 'None' else ''}",
-    f"Comparing years {reference_start_year}-{reference_end_year} to {focus_start_year}-{focus_end_year}",
-    f"{'Showing only geographic precincts' if geographic_precincts_only_selector > 0 else ''}",
-    f"{'Showing precincts/commands with at least ' + str(minimum_instances_threshold) + ' complaints in at least one year of each period' if minimum_instances_threshold > 0 else ''}" 
+complaints_params = ccrb_engine.describe_complaints(
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    (reference_start_year, reference_end_year),
+    (focus_start_year, focus_end_year),
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
 )
 
 complaints_title = '\n\n'.join(complaints_params)
@@ -542,34 +669,53 @@ ranges = pd.DataFrame({
 
 ## summarize cases
 
-cases_subset = (
-    cases
+count_cases_selected = count_selected_cases(case_years, with_settlement_only_selected)
+
+cases_summary = summarize_cases(
+    case_years,
+    with_settlement_only_selected,
+    normalize_by_selected,
+    aggregation_level_selected,
+    rolled_up_geographic_only
+)
+
+## precinct metrics
+# everything the maps are colored by, one row per command; above the command
+# level each precinct is colored by its group's values
+
+PRECINCT_METRICS = [
+    'pct_change',
+    'Count of cases',
+    'Settlement grand total',
+    'Median settlement'
+]
+
+precinct_metrics = pd.concat(
     [
-        (cases['Date of Occurrence'].dt.year.ge(case_years[0]))
-        & (cases['Date of Occurrence'].dt.year.le(case_years[1]))
-    ]
+        change_by_precinct_filtered_to_more_than_threshold_instances[['pct_change']],
+        cases_summary[PRECINCT_METRICS[1:]]
+    ],
+    axis=1
 )
 
-if with_settlement_only_selected:
-    cases_subset = (
-        cases_subset
-        [
-            cases['Total City Payout AMT'] > 0
-        ]
+if aggregation_level_selected != COMMAND_LEVEL:
+    precinct_metrics = spread_to_precincts(
+        precinct_metrics,
+        load_command_groups(aggregation_level_selected, rolled_up_geographic_only),
+        load_command_registry()
     )
 
+precinct_metrics = (
+    precinct_metrics
+    .rename_axis('command_normalized')
+    .reset_index()
+    .astype({'command_normalized':str})
+)
 
 with st.expander(label="Show portion of cases selected"):
         st.altair_chart(
             (
-                cases
-                .groupby(
-                    pd.Grouper(freq='YE',key='Date of Occurrence')
-                )
-                .size()
-                .rename('count cases')
-                .loc['2005-12-31':]
-                .reset_index()
+                count_cases_by_year()
                 .assign(
                     selected = lambda row: np.where(
                         (
@@ -616,7 +762,7 @@ with st.expander(label="Show portion of cases selected"):
             use_container_width=True
         )
 
-        st.write(f"{cases_subset.shape[0]:,.0f} cases selected")
+        st.write(f"{count_cases_selected:,.0f} cases selected")
 
 # if case_summary_selected == 'Count of cases':
 
@@ -662,48 +808,12 @@ with st.expander(label="Show portion of cases selected"):
     # )
 
 
-cases_summary = (
-    (
-        cases_subset
-        .groupby('command_normalized')
-        .size()
-        .div(normalizer)
-        .rename('Count of cases')
-        .to_frame()
-    )
-    .join(
-    (
-        cases_subset
-            .groupby('command_normalized')
-            ['Total City Payout AMT']
-            .sum()
-            .div(normalizer)
-            .sort_values(ascending=False)
-            .rename('Settlement grand total')
-        ),
-        how='outer'
-    )
-    .join(
-        (
-            cases_subset
-            .groupby('command_normalized')
-            ['Total City Payout AMT']
-            .median()
-            .sort_values(ascending=False)
-            .rename('Median settlement')
-        ),
-        how='outer'
-    )
-    # .sort_values(by=case_summary_selected, ascending=False)
-)
-
-cases_params = (
-    "Count of cases, Settlement grand total",
-    f"{'per '+ normalize_by_selected.lower() if normalize_by_selected != 'None' else ''}",
-    "and Median settlement",
-    "by precinct",
-    f"From incidents that occurred {case_years[0]} - {case_years[1]}",
-    f"{'Showing only cases with settlement payment' if with_settlement_only_selected else ''}"
+cases_params = ccrb_engine.describe_cases(
+    case_years,
+    with_settlement_only_selected,
+    normalize_by_selected,
+    aggregation_level_selected,
+    rolled_up_geographic_only
 )
 
 cases_title = '\n\n'.join(cases_params)
@@ -750,23 +860,99 @@ with st.container():
             cases_summary
             .reset_index()
             .rename(columns={
-                'command_normalized':'Precinct/command',
+                'command_normalized':aggregation_level_selected,
             })
-            .set_index('Precinct/command')
+            .set_index(aggregation_level_selected)
             .sort_values(by='Count of cases', ascending=False)
             .style.format({
                 'Count of cases':'{:,.0f}',
                 'Settlement grand total':'$ {:,.2f}',
-                'Median settlement':'$ {:,.2f}'
+                'Median settlement':'$ {:,.2f}',
+                '90th percentile settlement':'$ {:,.2f}',
+                '99th percentile settlement':'$ {:,.2f}'
             })
         )
 
 # jumbo altair linked viz
 
+## chart specs
+# each column of the viz is serialized once per combination of the
+# parameters it is drawn from, so e.g. changing the case years reuses the
+# complaints column's JSON and only serializes the cases maps. The
+# demographics maps never change and are serialized once per process.
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=100)
+def chart_spec(chart_name, parameters, _chart):
+    return chart_to_json(_chart)
+
+# the maps carry no data of their own: the precinct geometry is declared once
+# at the top of the viz and joined there to precinct_metrics, one tidy row per
+# command with every value the maps are colored by, and to the census
+# demographics table built alongside the boundaries. The metrics table is
+# attached after the cached JSON is loaded, so it is the only part of the
+# maps that changes between reruns.
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=100)
+def viz_spec(complaints_parameters, cases_parameters, _complaints_column, _cases_column, _demographics_maps):
+    return concat_specs(
+        [
+            chart_spec('complaints', complaints_parameters, _complaints_column),
+            chart_spec('cases', cases_parameters, _cases_column),
+            chart_spec('demographics', (), _demographics_maps)
+        ],
+        config={'concat':{'spacing':20}},
+        data=precincts.to_dict(),
+        transform=[
+            {
+                'calculate':'toString(datum.properties.Precinct)',
+                'as':'command_normalized'
+            },
+            {
+                'lookup':'command_normalized',
+                'from':{
+                    'data':{'name':'precinct_metrics'},
+                    'key':'command_normalized',
+                    'fields':PRECINCT_METRICS
+                }
+            },
+            {
+                'lookup':'command_normalized',
+                'from':{
+                    'data':{'url':f"app/static/{load_precincts_manifest()['demographics']['file']}"},
+                    'key':'command_normalized',
+                    'fields':load_precincts_manifest()['demographics']['fields']
+                }
+            }
+        ]
+    )
+
+complaints_parameters = (
+    fado_types_selected,
+    substantiated_only_selected,
+    normalize_by_selected,
+    (reference_start_year, reference_end_year),
+    (focus_start_year, focus_end_year),
+    geographic_precincts_only_selector,
+    minimum_instances_threshold,
+    aggregation_level_selected
+)
+
+cases_parameters = (
+    case_years,
+    with_settlement_only_selected,
+    normalize_by_selected,
+    aggregation_level_selected,
+    rolled_up_geographic_only
+)
+
 ## build visuals
 
-with st.spinner(text='reloading maps and charts...'):
+with st.spinner(text='reloading maps and charts...'), stage('build_charts'):
+    # named so the selection links across the separately serialized columns
     highlight = alt.selection_point(
+        name='highlight',
         on='click', 
         fields=['command_normalized'], 
         # nearest=True,
@@ -775,34 +961,24 @@ with st.spinner(text='reloading maps and charts...'):
         toggle=False
     )
 
+    # the maps draw the precinct geometry inherited from the top of the viz,
+    # already joined to precinct_metrics (see viz_spec)
     base_map = (
-        alt.Chart(precincts)
+        alt.Chart()
         .mark_geoshape(
             color='white',
             stroke='lightgrey'
         )
         .project('mercator')
         .properties(
-            width=300
+            width=MAP_WIDTH
         )
     )
 
     complaints_map = base_map + (
         alt.Chart(
-            precincts,
             title=f"Change in number of CCRB complaints {complaints_params[1]}"
         )
-        .transform_calculate(
-            command_normalized = 'toString(datum.properties.Precinct)'
-        )
-        .transform_lookup(
-            lookup='command_normalized',
-            from_=alt.LookupData(
-                data=change_by_precinct_filtered_to_more_than_threshold_instances.reset_index(),
-                key='command_normalized',
-                fields=['pct_change']
-            )
-        )
         .mark_geoshape()
         .encode(
             color=alt.Color(
@@ -896,7 +1072,7 @@ with st.spinner(text='reloading maps and charts...'):
             ),
             color=alt.Color(
                 'command_normalized:N',
-                title='Precinct/command (Top 10 by pct change)',
+                title=f'{aggregation_level_selected} (Top 10 by pct change)',
                 legend=alt.Legend(
                     # columns=2,
                     orient='left'
@@ -910,7 +1086,7 @@ with st.spinner(text='reloading maps and charts...'):
             tooltip=[
                 alt.Tooltip(
                     'command_normalized',
-                    title='Precinct/command'
+                    title=aggregation_level_selected
                 ),
                 alt.Tooltip(
                     'count_complaints',
@@ -984,7 +1160,7 @@ with st.spinner(text='reloading maps and charts...'):
             ),
             color=alt.Color(
                 'command_normalized',
-                title='Precinct/command (Top 10 by pct change)',
+                title=f'{aggregation_level_selected} (Top 10 by pct change)',
                 legend=alt.Legend(
                     # columns=2,
                     orient='left'
@@ -997,7 +1173,7 @@ with st.spinner(text='reloading maps and charts...'):
                 ),
                 alt.Tooltip(
                     'command_normalized',
-                    title='Precinct/command'
+                    title=aggregation_level_selected
                 ),
                 alt.Tooltip(
                 'rank',
@@ -1019,22 +1195,8 @@ with st.spinner(text='reloading maps and charts...'):
     cases_count_map = (
         base_map + (
         alt.Chart(
-            precincts,
             title=f'Count of cases {cases_params[1]}'
         )
-        .transform_calculate(
-            command_normalized = 'toString(datum.properties.Precinct)'
-        )
-        .transform_lookup(
-            lookup='command_normalized',
-            from_=alt.LookupData(
-                data=(
-                    cases_summary.reset_index()
-                ),
-                key='command_normalized',
-                fields=['Count of cases']
-            )
-        )
         .mark_geoshape()
         .encode(
             color=alt.Color(
@@ -1077,22 +1239,8 @@ with st.spinner(text='reloading maps and charts...'):
     settlement_total_map = (
         base_map + (
         alt.Chart(
-            precincts,
             title=f'Settlement total {cases_params[1]}'
         )
-        .transform_calculate(
-            command_normalized = 'toString(datum.properties.Precinct)'
-        )
-        .transform_lookup(
-            lookup='command_normalized',
-            from_=alt.LookupData(
-                data=(
-                    cases_summary.reset_index()
-                ),
-                key='command_normalized',
-                fields=['Settlement grand total']
-            )
-        )
         .mark_geoshape()
         .encode(
             color=alt.Color(
@@ -1134,22 +1282,8 @@ with st.spinner(text='reloading maps and charts...'):
     median_settlement_map = (
         base_map + (
         alt.Chart(
-            precincts,
             title='Median settlement'
         )
-        .transform_calculate(
-            command_normalized = 'toString(datum.properties.Precinct)'
-        )
-        .transform_lookup(
-            lookup='command_normalized',
-            from_=alt.LookupData(
-                data=(
-                    cases_summary.reset_index()
-                ),
-                key='command_normalized',
-                fields=['Median settlement']
-            )
-        )
         .mark_geoshape()
         .encode(
             color=alt.Color(
@@ -1189,11 +1323,8 @@ with st.spinner(text='reloading maps and charts...'):
 
 
     demographics_base = (
-        alt.Chart(precincts)
+        alt.Chart()
         .mark_geoshape()
-        .transform_calculate(
-            command_normalized = 'toString(datum.properties.Precinct)'
-        )
         .encode(
             stroke=alt.condition(
                 highlight, 
@@ -1215,7 +1346,7 @@ with st.spinner(text='reloading maps and charts...'):
         demographics_base
         .encode(
             color=alt.Color(
-                'properties.White__pct:Q',
+                'White__pct:Q',
                 title='Pct White',
                 scale=alt.Scale(
                     scheme='blues',
@@ -1232,7 +1363,7 @@ with st.spinner(text='reloading maps and charts...'):
         demographics_base
         .encode(
             color=alt.Color(
-                'properties.Black__pct:Q',
+                'Black__pct:Q',
                 title='Pct Black',
                 scale=alt.Scale(
                     scheme='purples',
@@ -1249,7 +1380,7 @@ with st.spinner(text='reloading maps and charts...'):
         demographics_base
         .encode(
             color=alt.Color(
-                'properties.Asian_pct:Q',
+                'Asian_pct:Q',
                 title='Pct Asian',
                 scale=alt.Scale(
                     scheme='teals',
@@ -1266,7 +1397,7 @@ with st.spinner(text='reloading maps and charts...'):
         demographics_base
         .encode(
             color=alt.Color(
-                'properties.Hispanic__pct:Q',
+                'Hispanic__pct:Q',
                 title='Pct Hispanic',
                 scale=alt.Scale(
                     scheme='greens',
@@ -1283,7 +1414,7 @@ with st.spinner(text='reloading maps and charts...'):
         demographics_base
         .encode(
             color=alt.Color(
-                'properties.below_150_pct_poverty_level__pct:Q',
+                'below_150_pct_poverty_level__pct:Q',
                 title='Pct below 150 pct poverty level',
                 scale=alt.Scale(
                     scheme='oranges',
@@ -1302,7 +1433,8 @@ with st.spinner(text='reloading maps and charts...'):
             asian_pct,
             hispanic_pct,
             poverty_pct,
-            title='Demographics'
+            title='Demographics',
+            data=precincts
         ).resolve_scale(color='independent')
 
 
@@ -1325,37 +1457,53 @@ with st.spinner(text='reloading maps and charts...'):
     #     cases_map
     # ])
 
-    viz = (
-        (
-            complaints_map & (
-                (top_10_trend_line_chart + shading + average_trend_chart)
-                .resolve_scale(
-                    color='independent'    
-                )
-            ) & (
-            (precincts_rank_chart + shading)
-                .resolve_scale(
-                    color='independent'    
-                )
+    complaints_column = (
+        complaints_map & (
+            (top_10_trend_line_chart + shading + average_trend_chart)
+            .resolve_scale(
+                color='independent'    
+            )
+        ) & (
+        (precincts_rank_chart + shading)
+            .resolve_scale(
+                color='independent'    
             )
-        ).resolve_scale(color='independent') | (
-            cases_count_map
-            &
-            settlement_total_map
-            &
-            median_settlement_map
-        ).resolve_scale(
-            color='independent'
-        ) | (
+        )
+    ).resolve_scale(
+        color='independent'
+    ).properties(
+        data=precincts
+    )
+
+    cases_column = (
+        cases_count_map
+        &
+        settlement_total_map
+        &
+        median_settlement_map
+    ).resolve_scale(
+        color='independent'
+    ).properties(
+        data=precincts
+    )
+
+    viz = json.loads(
+        viz_spec(
+            complaints_parameters,
+            cases_parameters,
+            complaints_column,
+            cases_column,
             demographics_maps
         )
-    ).configure_concat(
-        spacing=20
     )
+    viz['datasets'] = {
+        **viz.get('datasets', {}),
+        'precinct_metrics': precinct_metrics
+    }
 
 with st.container():
 
-        st.altair_chart(
+        st.vega_lite_chart(
             viz, 
             # use_container_width=True
         )
@@ -1364,144 +1512,278 @@ with st.container():
         #     demographics_maps
         # )
 
-# download buttons
+## recent changes
+# the year sliders above compare whole years; here the same complaints are
+# counted by quarter or month, and each trailing window is compared with the
+# window before it (or the same window a year earlier), so short-term spikes
+# show up
+
 with st.container():
-    
-    ccrb_download_col, cases_download_col = st.columns(2,gap='small')
 
-    with ccrb_download_col:
+    st.write('## Recent changes')
 
-        complaints_pct_change_output = (
-            pd.concat([
-                pd.Series(
-                    complaints_params,
-                    name='params'
-                ),
-                (
-                    change_by_precinct_filtered__labeled
-                    .reset_index()
-                )
-            ],axis=1)
+    granularity_col, window_col, comparison_col, rolling_threshold_col = st.columns(4, gap='small')
+
+    with granularity_col:
+        granularity_selected = st.radio(
+            label='Count complaints by:',
+            options=ROLLING_GRANULARITIES,
+            horizontal=True
         )
 
-        st.download_button(
-            label='Download complaints pct change',
-            data=complaints_pct_change_output.to_csv(index=False),
-            file_name='complaints_pct_change.csv',
-            mime='text/csv'
+    with window_col:
+        window_periods = st.slider(
+            label=f'Trailing window ({granularity_selected.lower()}s):',
+            min_value=1,
+            max_value=2 * periods_per_year(granularity_selected),
+            value=periods_per_year(granularity_selected)
         )
 
-        complaints_annual_detail_output = (
-            pd.concat([
-                pd.Series(
-                    complaints_params,
-                    name='params'
-                ),
-                (
-                    normalized_by_year_by_command
-                    .rename_axis(index=['Year','Precinct/command'])
-                    .unstack('Year')
-                    .reset_index()
-                )
-            ],axis=1)
+    with comparison_col:
+        comparison_selected = st.radio(
+            label='Compare to:',
+            options=ROLLING_COMPARISONS,
+            horizontal=True
         )
 
-        st.download_button(
-            label='Download complaints by precinct by year',
-            data=(
-                complaints_annual_detail_output
-                .to_csv(index=False)
+    with rolling_threshold_col:
+        rolling_threshold = st.slider(
+            label=f'Hide precincts/commands without this many complaints in at least one {granularity_selected.lower()} of either window',
+            min_value=0,
+            max_value=10,
+            value=1
+        )
+
+    rolling = rolling_changes(
+        fado_types_selected,
+        substantiated_only_selected,
+        normalize_by_selected,
+        geographic_precincts_only_selector,
+        aggregation_level_selected,
+        granularity_selected,
+        window_periods,
+        comparison_selected,
+        rolling_threshold
+    )
+    latest_changes = ccrb_engine.latest_changes(rolling)
+
+    st.write('\n\n'.join(ccrb_engine.describe_rolling(
+        granularity_selected,
+        window_periods,
+        comparison_selected,
+        rolling_threshold,
+        rolling
+    )))
+
+    latest_table_col, rolling_chart_col = st.columns(2, gap='small')
+
+    latest_changes_labeled = ccrb_engine.label_latest_changes(
+        latest_changes,
+        granularity_selected,
+        window_periods,
+        aggregation_level_selected
+    )
+
+    with latest_table_col:
+        st.dataframe(
+            latest_changes_labeled
+            .style.format({
+                **{
+                    column:'{:.3f}' if isinstance(normalizer, pd.Series) else '{:.1f}'
+                    for column in latest_changes_labeled.columns
+                },
+                'Pct change':'{:.0%}'
+            })
+        )
+
+    with rolling_chart_col:
+        # the trailing window's change over time, for the commands with the
+        # largest latest changes
+        top_recent = ccrb_engine.top_changes(latest_changes, TOP_COMMANDS).index
+        rolling_top = rolling[rolling.index.get_level_values('command_normalized').isin(top_recent)]
+
+        st.altair_chart(
+            pd.DataFrame({
+                'period_start': period_start(rolling_top.index.get_level_values(0), granularity_selected),
+                aggregation_level_selected: rolling_top.index.get_level_values('command_normalized').astype(str),
+                'Pct change': rolling_top['pct_change'].to_numpy()
+            })
+            .pipe(alt.Chart)
+            .mark_line(point=True)
+            .encode(
+                x=alt.X('period_start:T', title='Window ending'),
+                y=alt.Y('Pct change:Q', axis=alt.Axis(format='%')),
+                color=alt.Color(f'{aggregation_level_selected}:N', sort=list(top_recent.astype(str))),
+                tooltip=[
+                    f'{aggregation_level_selected}:N',
+                    alt.Tooltip('period_start:T', title='Window ending'),
+                    alt.Tooltip('Pct change:Q', format='.0%')
+                ]
             ),
-            file_name='complaints_by_precinct_by_year.csv',
-            mime='text/csv'
+            use_container_width=True
         )
 
+## downloads
+# the download files are only built when their button is clicked (Streamlit
+# calls a callable data= on a separate thread then, off the rerun), from the
+# cached stages, and are cached on the parameters they're computed from
+
+# format -> (file extension, MIME type) of the per-table downloads
+DOWNLOAD_FORMATS = {
+    'CSV': ('csv', CSV_MIME),
+    'Parquet': ('parquet', PARQUET_MIME)
+}
+
+def complaints_pct_change_download(complaints_parameters):
+    _, _, _, reference_years, focus_years, _, _, aggregation_level = complaints_parameters
+
+    return ccrb_engine.complaints_pct_change_table(
+        ccrb_engine.label_change_by_precinct(
+            filter_to_threshold(*complaints_parameters),
+            reference_years,
+            focus_years,
+            aggregation_level
+        )
+    )
 
-        # output = BytesIO()
-        # # workbook = xlsxwriter.Workbook(output, {'in_memory': True})
-
-        # with pd.ExcelWriter(path=output, mode='w') as writer:
-
-        #     # parameters_sheet = workbook.add_worksheet(name='parameters')
-        #     # parameters_sheet.write('A1', complaints_title)
-
-        #     (
-        #         change_by_precinct_filtered__labeled
-        #         .to_excel(
-        #             writer,
-        #             sheet_name='pct_change'
-        #         )
-        #     )
-
-        #     (
-        #         normalized_by_year_by_command
-        #         .unstack()
-        #         .to_excel(
-        #             writer,
-        #             sheet_name='by_precinct_by_year'
-        #         )
-        #     )
-
-
-        #     st.download_button(
-        #         label="Download Excel workbook",
-        #         data=output.getvalue(),
-        #         file_name="workbook.xlsx",
-        #         mime="application/vnd.ms-excel"
-        #     )
-
-
-        # st.download_button(
-        #     label='Download pct change',
-        #     data=(
-        #             pd.concat([
-        #             pd.DataFrame({'Parameters':complaints_params}),
-        #             change_by_precinct_filtered__labeled.reset_index()
-        #         ])
-        #         .to_csv(index=False)
-        #     ),
-        #     file_name='complaints_pct_change.csv',
-        #     mime='text/csv'
-        # )
+def complaints_annual_detail_download(complaints_parameters):
+    fado_types, substantiated_only, normalize_by, _, _, geographic_precincts_only, _, aggregation_level = complaints_parameters
 
-        # st.download_button(
-        #     label='Download annual detail',
-        #     data=(
-        #             pd.concat([
-        #             pd.DataFrame({'Parameters':complaints_params}),
-        #             (
-        #                 normalized_by_year_by_command
-        #                 .rename_axis(index=['Year','Precinct/command'])
-        #                 .unstack()
-        #             )
-        #         ])
-        #         .to_csv()
-        #     ),
-        #     file_name='complaints_by_precinct_by_year.csv',
-        #     mime='text/csv'
-        # )
+    return ccrb_engine.complaints_annual_detail_table(
+        normalize_complaints(
+            fado_types,
+            substantiated_only,
+            normalize_by,
+            aggregation_level,
+            ccrb_engine.rolls_up_geographic_only(aggregation_level, geographic_precincts_only)
+        ),
+        aggregation_level
+    )
+
+def cases_summary_download(cases_parameters):
+    _, _, _, aggregation_level, _ = cases_parameters
+
+    return ccrb_engine.cases_summary_table(
+        summarize_cases(*cases_parameters),
+        aggregation_level
+    )
+
+def write_download(table, params, download_format):
+    if download_format == 'Parquet':
+        return write_parquet(table, params)
+    return write_csv(ccrb_engine.with_params(table, params))
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=20)
+def complaints_pct_change_file(complaints_parameters, download_format):
+    return write_download(
+        complaints_pct_change_download(complaints_parameters),
+        ccrb_engine.describe_complaints(*complaints_parameters),
+        download_format
+    )
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=20)
+def complaints_annual_detail_file(complaints_parameters, download_format):
+    return write_download(
+        complaints_annual_detail_download(complaints_parameters),
+        ccrb_engine.describe_complaints(*complaints_parameters),
+        download_format
+    )
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=20)
+def cases_summary_file(cases_parameters, download_format):
+    return write_download(
+        cases_summary_download(cases_parameters),
+        ccrb_engine.describe_cases(*cases_parameters),
+        download_format
+    )
+
+@instrumented()
+@st.cache_data(show_spinner=False, max_entries=20)
+def excel_workbook(complaints_parameters, cases_parameters):
+    return write_excel(
+        {
+            'pct_change': complaints_pct_change_download(complaints_parameters),
+            'by_precinct_by_year': complaints_annual_detail_download(complaints_parameters),
+            'cases_summary': cases_summary_download(cases_parameters)
+        },
+        ccrb_engine.describe_complaints(*complaints_parameters) + ccrb_engine.describe_cases(*cases_parameters)
+    )
+
+# download buttons
+with st.container():
+
+    download_format = st.radio(
+        label='Download format:',
+        options=DOWNLOAD_FORMATS,
+        horizontal=True
+    )
+    download_extension, download_mime = DOWNLOAD_FORMATS[download_format]
     
-    with cases_download_col:
+    ccrb_download_col, cases_download_col = st.columns(2,gap='small')
 
+    with ccrb_download_col:
 
-        cases_output = pd.concat([
-            pd.Series(
-                cases_params,
-                name='params'
-            ),
-            (
-                cases_summary
-                .reset_index()
-                .rename(columns={
-                    'command_normalized':'Precinct/command',
-                })
-            )
-        ],axis=1)
+        st.download_button(
+            label='Download complaints pct change',
+            data=partial(complaints_pct_change_file, complaints_parameters, download_format),
+            file_name=f'complaints_pct_change.{download_extension}',
+            mime=download_mime
+        )
+
+        st.download_button(
+            label='Download complaints by precinct by year',
+            data=partial(complaints_annual_detail_file, complaints_parameters, download_format),
+            file_name=f'complaints_by_precinct_by_year.{download_extension}',
+            mime=download_mime
+        )
+    
+    with cases_download_col:
 
-        
         st.download_button(
             label='Download cases summary',
-            data = cases_output.to_csv(index=False),
-            file_name='cases_summary.csv',
-            mime='txt/csv'
+            data=partial(cases_summary_file, cases_parameters, download_format),
+            file_name=f'cases_summary.{download_extension}',
+            mime=download_mime
+        )
+
+    if EXCEL_AVAILABLE:
+        # parameters, pct change, annual detail and cases summary sheets
+        st.download_button(
+            label='Download Excel workbook (all tables)',
+            data=partial(excel_workbook, complaints_parameters, cases_parameters),
+            file_name='ccrb_complaints_and_cases.xlsx',
+            mime=EXCEL_MIME
         )
+
+## stage timings
+
+if stage_recorder is not None:
+    stage_recorder.finish()
+
+    if log_stage_timings:
+        stage_recorder.log()
+
+    if show_stage_timings:
+        with st.expander(label='Stage timings (debug)'):
+            st.write(f"Rerun took {stage_recorder.seconds:.3f} s")
+            st.dataframe(
+                pd.DataFrame(stage_recorder.as_records())
+                .assign(
+                    # nested stages run inside (and count towards) the stage above
+                    stage = lambda row: row['depth'].map(lambda depth: '\u00a0' * 4 * depth) + row['stage'],
+                    ms = lambda row: row['seconds'] * 1000,
+                    peak_kib = lambda row: row['peak_bytes'] / 1024,
+                    retained_kib = lambda row: row['retained_bytes'] / 1024
+                )
+                [['stage','ms','rows_in','rows_out','peak_kib','retained_kib']]
+                .style.format({
+                    'ms':'{:,.1f}',
+                    'rows_in':'{:,.0f}',
+                    'rows_out':'{:,.0f}',
+                    'peak_kib':'{:,.0f}',
+                    'retained_kib':'{:,.0f}'
+                }, na_rep='')
+            )
@@ -0,0 +1,149 @@
+import numpy as np
+
+## mergeable quantile sketch (KLL)
+# a stack of compactors: level h holds items that each stand for 2**h of the
+# original values. When a level outgrows its capacity it is sorted and every
+# other item is promoted to the level above, halving it. Capacities shrink
+# geometrically (by 2/3) from the top level down, so a sketch holds
+# O(k) items however many values went in, and quantiles carry a rank error
+# of roughly 1/k.
+#
+# sketches merge by concatenating their levels and compacting again, so
+# per-cell sketches built once can answer quantiles over any union of cells.
+# Until a sketch first compacts it holds every value, i.e. it is exact.
+#
+# each compaction keeps the even or the odd items at random, so its rank
+# errors cancel out rather than pile up: a fixed alternation of the two
+# pushes every cell's error the same way, and merging thousands of cells
+# adds the errors up. The coins come from a generator seeded per sketch (a
+# cube's cells get their own seeds, a merge's seed derives from its
+# inputs'), so building the same cube twice gives the same sketches, and
+# merging them the same numbers in the app.
+
+DEFAULT_K = 200
+
+def merged_seed(seeds):
+    return int(np.random.SeedSequence(seeds).generate_state(1)[0])
+
+def merged_k(base_k, leaves):
+    # a merge's compactions add rank error on top of its inputs', so a
+    # sketch merged from more leaf sketches gets a larger k, keeping the
+    # error of e.g. a citywide percentile (thousands of command/year cells)
+    # near a single cell's. It's a function of the leaves alone, so merging
+    # merged sketches (a roll-up of roll-ups) gets the k of merging their
+    # leaves at once, and a sketch holds O(k log leaves) items
+    return base_k * max(1, int(np.ceil(np.log2(max(leaves, 1)))))
+
+class KLLSketch:
+
+    def __init__(self, k=DEFAULT_K, seed=0, leaves=1):
+        # k of the sketches the leaves were built with, and how many were
+        # merged into this one
+        self.base_k = k
+        self.leaves = leaves
+        self.k = merged_k(k, leaves)
+        self.compactors = [np.empty(0)]
+        self.count = 0
+        self.seed = seed
+        self.random = np.random.default_rng(seed)
+
+    @classmethod
+    def from_values(cls, values, k=DEFAULT_K, seed=0):
+        return cls(k, seed).update(values)
+
+    def capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.count += len(values)
+        self.compress()
+        return self
+
+    def merge(self, other):
+        return merge_sketches([self, other])
+
+    def compress(self):
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                items = np.sort(items)
+                # an odd item out stays behind at this level
+                kept = items[:len(items) % 2]
+                paired = items[len(items) % 2:]
+
+                self.compactors[level] = kept
+                self.compactors[level + 1] = np.concatenate([
+                    self.compactors[level + 1],
+                    paired[self.random.integers(2)::2]
+                ])
+
+            level += 1
+
+    def is_exact(self):
+        return len(self.compactors) == 1
+
+    def weighted_items(self):
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([
+            np.full(len(compactor), 2 ** level, dtype=float)
+            for level, compactor in enumerate(self.compactors)
+        ])
+
+        order = np.argsort(items, kind='stable')
+        return items[order], weights[order]
+
+    def quantiles(self, quantiles):
+        quantiles = np.asarray(quantiles, dtype=float)
+
+        if self.count == 0:
+            return np.full(quantiles.shape, np.nan)
+
+        if self.is_exact():
+            return np.quantile(self.compactors[0], quantiles)
+
+        items, weights = self.weighted_items()
+        cumulative_weights = np.cumsum(weights)
+        ranks = quantiles * cumulative_weights[-1]
+
+        return items[
+            np.minimum(
+                np.searchsorted(cumulative_weights, ranks, side='left'),
+                len(items) - 1
+            )
+        ]
+
+def merge_sketches(sketches):
+    # every level of every sketch concatenated, then compacted once, which
+    # makes fewer (each one costing rank error) and cheaper compactions than
+    # merging the sketches one at a time
+    sketches = list(sketches)
+    if not sketches:
+        return KLLSketch()
+
+    merged = KLLSketch(
+        max(sketch.base_k for sketch in sketches),
+        merged_seed([sketch.seed for sketch in sketches]),
+        leaves=sum(sketch.leaves for sketch in sketches)
+    )
+    levels = max(len(sketch.compactors) for sketch in sketches)
+
+    merged.compactors = [
+        np.concatenate(
+            [np.empty(0)]
+            + [sketch.compactors[level] for sketch in sketches if level < len(sketch.compactors)]
+        )
+        for level in range(levels)
+    ]
+    merged.count = sum(sketch.count for sketch in sketches)
+    merged.compress()
+    return merged
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from command_registry import command_ids, mask_by_id, values_by_id
+from complaints_cube import cube_from_memberships
+
+## hierarchical roll-ups
+# the per-command aggregates (the cases cube's totals, the roster and index
+# crimes) summed up to patrol boroughs, boroughs or the whole city. A level
+# assigns each command id to at most one group, so rolling up is relabeling
+# the command ids of an aggregate with their groups and summing, without
+# going back to the cases.
+#
+# complaint counts can't be summed that way: a complaint with allegations in
+# two commands of a group is one of each command's complaints, but only one
+# of the group's. roll_up_complaints builds the groups' own complaints cube
+# instead, from the complaint memberships the per-command cube is built from,
+# with each command relabeled with its group, so each complaint is counted
+# once per group as it is once per command.
+#
+# normalized values are totaled then normalized: a group's complaints per
+# officer are the complaints in its commands over its commands' officers,
+# both over the commands the normalizer covers (covered_groups). A command
+# without officers on the roster (or without index crimes, i.e. any command
+# but a precinct) has no normalized value at the command level, and adds
+# nothing to its group's either, so every level normalizes the same
+# complaints.
+#
+# rolled-up tables keep the command_normalized name for their index, holding
+# the group names, so everything downstream of the aggregates (the year x
+# command matrix, the change table, the cases summary) runs on them
+# unchanged.
+
+LEVELS = (
+    'Precinct/command',
+    'Patrol borough',
+    'Borough',
+    'Citywide'
+)
+
+COMMAND_LEVEL = LEVELS[0]
+
+# registry attribute naming each command's group
+LEVEL_ATTRIBUTES = {
+    'Patrol borough': 'patrol_borough',
+    'Borough': 'borough'
+}
+
+CITYWIDE = 'Citywide'
+
+def command_groups(command_registry, level, geographic_precincts_only=False):
+    # the group of each command id at level, NaN for the commands outside
+    # every group (at the patrol borough and borough levels, the units
+    # serving the whole city); with geographic_precincts_only only the
+    # precincts are rolled up
+    if level == CITYWIDE:
+        groups = pd.Categorical.from_codes(np.zeros(len(command_registry), dtype=int), [CITYWIDE])
+    else:
+        groups = command_registry[LEVEL_ATTRIBUTES[level]].array
+
+    if geographic_precincts_only:
+        groups = pd.Categorical.from_codes(
+            np.where(command_registry['is_geographic'].to_numpy(), groups.codes, -1),
+            dtype=groups.dtype
+        )
+
+    return groups
+
+def group_index(index, groups):
+    # the group of each row of an index of commands (or with a command
+    # level), and which rows have one
+    ids = command_ids(index)
+    group_codes = np.where(ids >= 0, groups.codes[np.maximum(ids, 0)], -1)
+    has_group = group_codes >= 0
+
+    group_labels = pd.CategoricalIndex(
+        pd.Categorical.from_codes(group_codes[has_group], dtype=groups.dtype),
+        name='command_normalized'
+    )
+
+    return group_labels, has_group
+
+def roll_up(by_command, groups):
+    # sum a series or frame indexed by command (alone or with other levels)
+    # over each group
+    group_labels, has_group = group_index(by_command.index, groups)
+    index = by_command.index
+
+    if isinstance(index, pd.MultiIndex):
+        keys = [
+            group_labels if name == 'command_normalized' else index.get_level_values(name)[has_group]
+            for name in index.names
+        ]
+    else:
+        keys = [group_labels]
+
+    return (
+        by_command
+        [has_group]
+        .groupby(keys, observed=True)
+        .sum()
+    )
+
+def roll_up_complaints(complaint_memberships, groups):
+    # the complaints cube of the groups, indexed by their labels in place of
+    # the commands
+    group_labels, has_group = group_index(complaint_memberships['command_normalized'], groups)
+
+    return cube_from_memberships(
+        complaint_memberships
+        [has_group]
+        .assign(command_normalized=group_labels.array)
+    )
+
+def covered_groups(groups, normalizer):
+    # groups of only the commands the normalizer has a value for
+    if not isinstance(normalizer, pd.Series):
+        return groups
+
+    return pd.Categorical.from_codes(
+        np.where(~np.isnan(values_by_id(normalizer)), groups.codes, -1),
+        dtype=groups.dtype
+    )
+
+def covered_by(by_command, normalizer):
+    # the rows of commands the normalizer has a value for
+    if not isinstance(normalizer, pd.Series):
+        return by_command
+
+    return by_command[mask_by_id(~np.isnan(values_by_id(normalizer)), by_command.index)]
+
+def roll_up_normalized(by_command, normalizer, groups):
+    # the group sums of by_command (a series or frame of totals) per unit of
+    # the group sums of normalizer
+    return normalize_rolled_up(roll_up(covered_by(by_command, normalizer), groups), normalizer, groups)
+
+def normalize_rolled_up(rolled_up, normalizer, groups):
+    # totals by group over the commands the normalizer covers, per unit of
+    # the group sums of normalizer
+    if not isinstance(normalizer, pd.Series):
+        return rolled_up.div(normalizer)
+
+    # each row's normalizer picked by its group id
+    group_normalizer = values_by_id(roll_up(normalizer, groups))[command_ids(rolled_up.index)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if isinstance(rolled_up, pd.DataFrame):
+            return rolled_up.div(group_normalizer, axis=0)
+        return rolled_up / group_normalizer
+
+def spread_to_precincts(by_group, groups, command_registry):
+    # one row per precinct repeating its group's row, for the precinct maps
+    precinct_ids = np.flatnonzero(command_registry['is_geographic'].to_numpy())
+
+    return (
+        by_group
+        .reindex(groups.take(precinct_ids))
+        .set_axis(command_registry.index[precinct_ids])
+    )
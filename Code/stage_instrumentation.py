@@ -0,0 +1,197 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+## opt-in per-stage instrumentation
+# a StageRecorder collects, for each pipeline stage a rerun goes through, its
+# wall time, the rows it took in and handed out, and the memory it allocated.
+# Stages are the app's loaders, cached computations, chart and download
+# builders; each is wrapped with @instrumented (outside its Streamlit cache
+# decorator, so a cache hit is recorded too, as a fast stage that called
+# nothing) or run inside `with stage(...)`.
+#
+# stages nest: the cached stages call the stages they depend on, so a
+# stage's time and memory include its children's, and its rows in are the
+# rows out of the stages it called (or of the data it was handed directly).
+#
+# the recorder is held in a context variable set by the script run, so
+# concurrent sessions (one script thread each) record separately, and
+# nothing is recorded (or slowed down) unless a run starts a recorder.
+# Allocations are measured with tracemalloc, which traces the whole process
+# while any recorder tracks memory: with concurrent sessions a stage's bytes
+# include whatever other threads allocated meanwhile.
+
+logger = logging.getLogger('ccrb.stages')
+
+current_recorder = contextvars.ContextVar('current_recorder', default=None)
+
+tracing_lock = threading.Lock()
+tracing_users = 0
+
+def start_tracing():
+    global tracing_users
+    with tracing_lock:
+        if tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracing_users += 1
+
+def stop_tracing():
+    global tracing_users
+    with tracing_lock:
+        tracing_users -= 1
+        if tracing_users == 0:
+            tracemalloc.stop()
+
+def count_rows(value):
+    # rows of a frame, series or array; None for anything else (widget
+    # values, a chart)
+    shape = getattr(value, 'shape', None)
+    return int(shape[0]) if shape else None
+
+class StageRecord:
+
+    def __init__(self, name, depth, rows_in=None):
+        self.name = name
+        self.depth = depth
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.start_bytes = None
+        self.peak_bytes = None
+        self.retained_bytes = None
+        self.children_rows_out = []
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'depth': self.depth,
+            'seconds': self.seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'peak_bytes': self.peak_bytes,
+            'retained_bytes': self.retained_bytes
+        }
+
+class StageRecorder:
+
+    def __init__(self, session_id=None, track_memory=True):
+        self.session_id = session_id
+        self.track_memory = track_memory
+        self.records = []
+        self.stack = []
+        self.started = None
+        self.seconds = None
+
+    def start(self):
+        if self.track_memory:
+            start_tracing()
+        self.started = time.perf_counter()
+        current_recorder.set(self)
+        return self
+
+    def finish(self):
+        # also called on the recorder of a run that stopped early, to release
+        # its tracing; that run's thread may be gone, so the variable is
+        # only cleared where it is this recorder
+        if self.seconds is not None:
+            return
+        self.seconds = time.perf_counter() - self.started
+        if current_recorder.get() is self:
+            current_recorder.set(None)
+        if self.track_memory:
+            stop_tracing()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        record = StageRecord(name, len(self.stack), rows_in)
+        self.records.append(record)
+
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # tracemalloc keeps one peak: hand the enclosing stage the peak
+            # so far before resetting it for this one
+            if self.stack:
+                self.stack[-1].peak_bytes = max(self.stack[-1].peak_bytes, peak)
+            tracemalloc.reset_peak()
+            record.start_bytes = current
+            record.peak_bytes = current
+
+        self.stack.append(record)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - started
+            self.stack.pop()
+
+            if record.rows_in is None and record.children_rows_out:
+                record.rows_in = sum(record.children_rows_out)
+
+            if self.stack and record.rows_out is not None:
+                self.stack[-1].children_rows_out.append(record.rows_out)
+
+            if self.track_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(record.peak_bytes, peak)
+                record.retained_bytes = current - record.start_bytes
+                if self.stack:
+                    self.stack[-1].peak_bytes = max(self.stack[-1].peak_bytes, peak)
+                tracemalloc.reset_peak()
+                record.peak_bytes = peak - record.start_bytes
+
+    def as_records(self):
+        return [record.as_dict() for record in self.records]
+
+    def log(self):
+        # one JSON line per stage, tagged with the session and rerun
+        for record in self.as_records():
+            logger.info(json.dumps({
+                'session_id': self.session_id,
+                'run_seconds': self.seconds,
+                **record
+            }))
+
+@contextmanager
+def stage(name, rows_in=None):
+    recorder = current_recorder.get()
+    if recorder is None:
+        # a record nobody keeps, so callers can fill in rows either way
+        yield StageRecord(name, 0, rows_in)
+        return
+
+    with recorder.stage(name, rows_in) as record:
+        yield record
+
+def enable_logging(level=logging.INFO):
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    logger.setLevel(level)
+
+def instrumented(name=None):
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @wraps(function)
+        def run(*args, **kwargs):
+            if current_recorder.get() is None:
+                return function(*args, **kwargs)
+
+            data_rows = [
+                rows
+                for rows in map(count_rows, [*args, *kwargs.values()])
+                if rows is not None
+            ]
+
+            with stage(stage_name, sum(data_rows) if data_rows else None) as record:
+                result = function(*args, **kwargs)
+                record.rows_out = count_rows(result)
+                return result
+
+        return run
+
+    return decorator
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from quantile_sketch import DEFAULT_K, KLLSketch, merge_sketches
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+# payouts of many command/year cells, as the cases cube sketches them
+def cell_payouts(seed, n_cells=2000):
+    rng = np.random.default_rng(seed)
+    return [
+        rng.lognormal(10 + rng.normal(0, 1), 1.5, rng.integers(20, 400))
+        for _ in range(n_cells)
+    ]
+
+def rank_errors(sketch, values):
+    values = np.sort(values)
+    ranks = np.searchsorted(values, sketch.quantiles(QUANTILES), side='right') / len(values)
+    return np.abs(ranks - QUANTILES)
+
+def test_exact_until_first_compaction():
+    values = np.random.default_rng(0).lognormal(10, 1.5, DEFAULT_K)
+    sketch = KLLSketch.from_values(values)
+
+    assert sketch.is_exact()
+    np.testing.assert_array_equal(sketch.quantiles(QUANTILES), np.quantile(values, QUANTILES))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merging_many_cells_bounds_rank_error(seed):
+    cells = cell_payouts(seed)
+    sketches = [KLLSketch.from_values(cell, seed=cell_number) for cell_number, cell in enumerate(cells)]
+    values = np.concatenate(cells)
+
+    # citywide: every cell at once
+    assert rank_errors(merge_sketches(sketches), values).max() < 1 / DEFAULT_K
+
+    # one cell at a time
+    merged = sketches[0]
+    for sketch in sketches[1:200]:
+        merged = merged.merge(sketch)
+    assert rank_errors(merged, np.concatenate(cells[:200])).max() < 2 / DEFAULT_K
+
+def sketch_size(sketch):
+    return sum(len(compactor) for compactor in sketch.compactors)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_merging_merged_sketches_bounds_size_and_rank_error(seed):
+    cells = cell_payouts(seed)
+    sketches = [KLLSketch.from_values(cell, seed=cell_number) for cell_number, cell in enumerate(cells)]
+    values = np.concatenate(cells)
+    citywide = merge_sketches(sketches)
+
+    # roll-ups of roll-ups: cells into groups of 10, those into groups of
+    # 100, those citywide
+    merged = sketches
+    for group_size in [10, 10, 20]:
+        merged = [merge_sketches(merged[start:start + group_size]) for start in range(0, len(merged), group_size)]
+    [rolled_up] = merged
+
+    # k depends on the leaves merged, not on how often they were merged
+    assert rolled_up.k == citywide.k
+    # capacities shrink by 2/3 a level, so the levels hold under 3k items,
+    # plus the 2 any level may hold
+    assert sketch_size(rolled_up) <= 3 * rolled_up.k + 2 * len(rolled_up.compactors)
+    assert rank_errors(rolled_up, values).max() < 1 / DEFAULT_K
+
+def test_merges_are_reproducible():
+    cells = cell_payouts(0, n_cells=200)
+
+    def merged_quantiles():
+        return merge_sketches(
+            KLLSketch.from_values(cell, seed=cell_number) for cell_number, cell in enumerate(cells)
+        ).quantiles(QUANTILES)
+
+    np.testing.assert_array_equal(merged_quantiles(), merged_quantiles())
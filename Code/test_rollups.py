@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from command_registry import build_command_registry
+from complaints_cube import FADO_TYPES, complaint_memberships, count_by_year_by_command, cube_from_memberships
+from rollups import command_groups, covered_groups, normalize_rolled_up, roll_up_complaints
+
+COMMAND_DICTIONARY = pd.CategoricalDtype(['1', '75', '79', '120'])
+
+# complaint 1 has allegations in precincts 75 and 79, both in Brooklyn
+ALLEGATIONS = pd.DataFrame({
+    'Complaint Id': [1, 1, 2, 3],
+    'incident_year': [2019, 2019, 2019, 2019],
+    'incident_month': [3, 3, 5, 7],
+    'command_normalized': pd.Categorical(['75', '79', '75', '1'], dtype=COMMAND_DICTIONARY),
+    'FADO Type': ['Force', 'Abuse of Authority', 'Discourtesy', 'Force'],
+    'CCRB disposition substantiated': [False, True, False, False]
+})
+
+def count_at_level(level, fado_types=FADO_TYPES, substantiated_only=False):
+    groups = command_groups(build_command_registry(COMMAND_DICTIONARY), level)
+    cube = roll_up_complaints(complaint_memberships(ALLEGATIONS), groups)
+    return count_by_year_by_command(cube, fado_types, substantiated_only).loc[2019]
+
+def test_commands_count_complaints_once_each():
+    counts = count_by_year_by_command(cube_from_memberships(complaint_memberships(ALLEGATIONS)), FADO_TYPES, False).loc[2019]
+
+    assert counts.to_dict() == {'1': 1, '75': 2, '79': 1}
+
+def test_complaint_in_two_precincts_counted_once_per_group():
+    assert count_at_level('Borough').to_dict() == {'Brooklyn': 2, 'Manhattan': 1}
+    assert count_at_level('Patrol borough').to_dict() == {'PBBN': 2, 'PBMS': 1}
+    assert count_at_level('Citywide').to_dict() == {'Citywide': 3}
+
+def test_group_selection_matches_any_of_its_commands():
+    # complaint 1's force allegation is in 75 and its substantiated one in 79
+    assert count_at_level('Borough', ['Force']).to_dict() == {'Brooklyn': 1, 'Manhattan': 1}
+    assert count_at_level('Borough', FADO_TYPES, True).to_dict() == {'Brooklyn': 1}
+
+def test_normalizes_complaints_in_covered_commands():
+    # 79 has no officers on the roster, so Brooklyn's complaints per officer
+    # are 75's over 75's officers
+    officers = pd.Series(
+        [5.0, 10.0],
+        index=pd.CategoricalIndex(['1', '75'], dtype=COMMAND_DICTIONARY, name='command_normalized')
+    )
+    groups = command_groups(build_command_registry(COMMAND_DICTIONARY), 'Borough')
+    covered = count_by_year_by_command(
+        roll_up_complaints(complaint_memberships(ALLEGATIONS), covered_groups(groups, officers)),
+        FADO_TYPES,
+        False
+    )
+    normalized = normalize_rolled_up(covered, officers, groups).loc[2019]
+
+    np.testing.assert_allclose(normalized[['Brooklyn', 'Manhattan']].to_numpy(), [2 / 10, 1 / 5])